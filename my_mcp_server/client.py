@@ -1,15 +1,21 @@
 # 19/09/2025
 # Reference: https://modelcontextprotocol.io/quickstart/client 
-import asyncio, os, traceback, platform
+import asyncio, os, traceback, platform, time, threading
 from contextlib import AsyncExitStack
+import hashlib
 import json
 from mcp import ClientSession, StdioServerParameters
+import mcp.types as types
 from mcp.client.stdio import stdio_client
-from openai import OpenAI
+from openai import AsyncOpenAI
+from typing import Callable
 from mcp.client.streamable_http import streamablehttp_client
 from dotenv import load_dotenv
 from pathlib import Path
 from types import SimpleNamespace
+from history_log import HistoryLog, HistoryReader
+from history_window import HistoryWindow
+from tool_cache import ToolResultCache, parse_allowlist
 
 
 load_dotenv() # load environmental variables    
@@ -24,6 +30,55 @@ AGENT_SYSTEM = (
     "You must use exact tool names from the manifest when calling mcp_call_tool."
 )
 
+# tool calls of one model step run in parallel: at most this many at once, each with this timeout
+TOOL_CONCURRENCY = int(os.getenv("MCP_TOOL_CONCURRENCY", "4"))
+TOOL_TIMEOUT_S = float(os.getenv("MCP_TOOL_TIMEOUT_S", "60"))
+
+# idempotent tools whose results are reused within a session, tool=ttl_s ("prefix.tool" for one server only)
+TOOL_CACHE = parse_allowlist(os.getenv("MCP_TOOL_CACHE", ",".join([
+    "list_hazards=600", "list_hazards_batch=600", "solar_weather=600", "rank_solar_sites=600",
+    "search_satellites=3600", "search_satellite_by_id=3600",
+    "read_file=30", "read_text_file=30", "read_multiple_files=30", "list_directory=30",
+    "list_directory_with_sizes=30", "directory_tree=30", "search_files=30", "get_file_info=30",
+    "list_allowed_directories=3600",
+])))
+TOOL_CACHE_MAX = int(os.getenv("MCP_TOOL_CACHE_MAX", "256"))
+
+# servers listed here ("fs,gh", or * for all) are only started on the first call to one of their
+# tools, using the tool names saved by the previous run
+LAZY_SERVERS = {p.strip() for p in os.getenv("MCP_LAZY_SERVERS", "").split(",") if p.strip()}
+TOOLS_CACHE_PATH = os.getenv("MCP_TOOLS_CACHE_PATH", ".cache/client_tools.json")
+
+# prompt history is trimmed to this many tokens, system message included (see history_window.py)
+HISTORY_TOKENS = int(os.getenv("MCP_HISTORY_TOKENS", "16000"))
+
+# chat history log (see history_log.py)
+LOG_PATH = os.getenv("MCP_LOG_PATH", "chat_logs/log.jsonl")
+LOG_FSYNC = os.getenv("MCP_LOG_FSYNC", "interval")
+LOG_FSYNC_INTERVAL_S = float(os.getenv("MCP_LOG_FSYNC_INTERVAL_S", "5"))
+LOG_FLUSH_EVERY = int(os.getenv("MCP_LOG_FLUSH_EVERY", "1"))
+LOG_MAX_BYTES = int(os.getenv("MCP_LOG_MAX_BYTES", str(64 * 1024 * 1024)))
+# pick the conversation up where the last run left it: at least this many messages (0 = start fresh)
+LOG_RESUME_LAST = int(os.getenv("MCP_LOG_RESUME_LAST", "0"))
+
+# the model only ever sees one function, the real tools are listed in the system message
+TOOLS_SPEC = [{
+    "type": "function",
+    "function": {
+        "name": "mcp_call_tool",
+        "description": "Invoke an MCP tool by name with JSON arguments.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "tool_name": {"type": "string"},
+                "arguments": {"type": "object"},
+            },
+            "required": ["tool_name", "arguments"],
+            "additionalProperties": False
+        }
+    }
+}]
+
 def save_history_jsonl(history: list[dict], path: str):
     p = Path(path)
     p.parent.mkdir(parents=True, exist_ok=True)
@@ -43,17 +98,6 @@ def load_history_jsonl(path: str) -> list[dict]:
                 msgs.append(json.loads(line))
     return msgs
 
-def _append_history(history: list[dict], new_msgs: list[dict], keep_last:int=50) -> list[dict]:
-    """Append and keep only the most recent N messages."""
-    history.extend(new_msgs)
-    if keep_last and len(history) > keep_last:
-        # keep the system message if you have one at index 0
-        sys = history[:1] if history and history[0].get("role") == "system" else []
-        tail = history[-keep_last:]
-        history[:] = (sys + tail) if sys else tail
-    return history
-
-
 def get_documents_root() -> str:
     """
     Return the path to the user's Documents directory in a cross-platform way.
@@ -123,58 +167,119 @@ def _compact_manifest_items(tools_resp, include_schema: bool = True, max_chars:
     blob = json.dumps(items, indent=2)
     return blob[:max_chars]
 
+class ToolManifest:
+    '''
+    System message (agent instructions + tool manifest) cached for one session.
+    It is only rebuilt after invalidate(), i.e. when a server announces its tool list
+    changed or a new server gets registered, so a turn does not re-list every server.
+    '''
+    def __init__(self) -> None:
+        self._system_msg: dict | None = None
+        self.builds = 0
+
+    def invalidate(self) -> None:
+        self._system_msg = None
+
+    async def system_message(self, session) -> dict:
+        if self._system_msg is None:
+            tools_resp = await session.list_tools()
+            tools_manifest = _compact_manifest_items(tools_resp)
+            self._system_msg = {"role" : "system", "content": AGENT_SYSTEM + "\nAvailable Tools:\n" + tools_manifest}
+            self.builds += 1
+        return self._system_msg
+
+    def message_handler(self, on_change=None):
+        '''
+        ClientSession message_handler that drops the cache on tools/list_changed
+        '''
+        async def handler(message) -> None:
+            if isinstance(message, types.ServerNotification) and isinstance(message.root, types.ToolListChangedNotification):
+                self.invalidate()
+                if on_change is not None:
+                    on_change()
+        return handler
+
+async def _stream_completion(openai_client: AsyncOpenAI, on_token: Callable[[str], None] | None = None, **kwargs):
+    '''
+    Streamed chat completion rebuilt into a message-like object (.content, .tool_calls).
+    Text deltas go to on_token as soon as they arrive; tool-call deltas are stitched
+    together by their index (id and name come first, the arguments JSON in pieces).
+    '''
+    stream = await openai_client.chat.completions.create(stream=True, **kwargs)
+    content: list[str] = []
+    calls: dict[int, dict] = {}
+    async for chunk in stream:
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta
+        if delta.content:
+            content.append(delta.content)
+            if on_token is not None:
+                on_token(delta.content)
+        for tc in delta.tool_calls or []:
+            slot = calls.setdefault(tc.index, {"id": None, "type": "function", "name": [], "arguments": []})
+            if tc.id:
+                slot["id"] = tc.id
+            if tc.type:
+                slot["type"] = tc.type
+            if tc.function is not None:
+                if tc.function.name:
+                    slot["name"].append(tc.function.name)
+                if tc.function.arguments:
+                    slot["arguments"].append(tc.function.arguments)
+
+    tool_calls = [
+        SimpleNamespace(
+            id=c["id"],
+            type=c["type"],
+            function=SimpleNamespace(name="".join(c["name"]), arguments="".join(c["arguments"])),
+        )
+        for _, c in sorted(calls.items())
+    ]
+    return SimpleNamespace(content="".join(content), tool_calls=tool_calls or None)
+
 async def small_chat(
     session: ClientSession,
-    openai_client: OpenAI,
+    openai_client: AsyncOpenAI,
     user_prompt: str,
     model: str = "gpt-4o-mini",
     max_steps: int = 4,
-    history: list[dict] | None = None,
-    keep_last: int = 50
-) -> tuple[str, list[dict]]:
-    tools_resp = await session.list_tools()
-    tools_manifest = _compact_manifest_items(tools_resp)
-
-    system_msg = {"role" : "system", "content": AGENT_SYSTEM + "\nAvailable Tools:\n" + tools_manifest}
-    history = list(history or [])
-    if not history or history[0].get("role") != "system":
-        history.insert(0, system_msg)
-
-    tools_spec = [{
-        "type": "function",
-        "function": {
-            "name": "mcp_call_tool",
-            "description": "Invoke an MCP tool by name with JSON arguments.",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "tool_name": {"type": "string"},
-                    "arguments": {"type": "object"},
-                },
-                "required": ["tool_name", "arguments"],
-                "additionalProperties": False
-            }
-        }
-    }]
+    history: HistoryWindow | list[dict] | None = None,
+    manifest: ToolManifest | None = None,
+    on_token: Callable[[str], None] | None = None,
+    tool_concurrency: int | None = None,
+    tool_timeout_s: float | None = None,
+    log: HistoryLog | None = None,
+) -> tuple[str, HistoryWindow]:
+    tool_concurrency = tool_concurrency or TOOL_CONCURRENCY
+    tool_timeout_s = tool_timeout_s or TOOL_TIMEOUT_S
+    # without a cached manifest the tools are listed again for this turn
+    system_msg = await (manifest or ToolManifest()).system_message(session)
+    if not isinstance(history, HistoryWindow):
+        history = HistoryWindow(HISTORY_TOKENS, history or [])
+    # replaces the stored one when the tool list changed since the history started
+    history.set_system(system_msg)
 
     turn_msgs = [
         # {"role": "system", "content": AGENT_SYSTEM + "\nAvailable tools:\n" + tools_manifest},
         {"role": "user", "content": user_prompt},
     ]
-    messages = history + turn_msgs
+    messages = history.messages() + turn_msgs
 
     last_tool_text: str | None = None
 
     for _ in range(max_steps):
-        resp = openai_client.chat.completions.create(
+        # awaited and streamed, so MCP sessions keep being serviced while the model generates
+        msg = await _stream_completion(
+            openai_client,
+            on_token,
             model=model,
             messages=messages,
-            tools=tools_spec,
+            tools=TOOLS_SPEC,
             tool_choice="auto",
             temperature=0,
             max_tokens=700,
         )
-        msg = resp.choices[0].message
 
         # 1) If the model is done (no tool_calls) -> return content or fallbacks
         if not getattr(msg, "tool_calls", None):
@@ -182,9 +287,11 @@ async def small_chat(
 
             turn_msgs.append({"role": "assistant", "content": content})
 
-            updated = _append_history(history, turn_msgs, keep_last=keep_last)
+            if log is not None:
+                log.append(turn_msgs, system=system_msg)
+            history.extend(turn_msgs)
             # Final fallback
-            return (content or (last_tool_text or "(no content)")), updated
+            return (content or (last_tool_text or "(no content)")), history
 
         shell = {
             "role": "assistant",
@@ -194,86 +301,274 @@ async def small_chat(
         turn_msgs.append(shell)
         messages.append(shell)
 
-        # 3) Execute each tool call
-        for call in msg.tool_calls:
+        # 3) Execute the tool calls of this step concurrently, replies keep the call order
+        sem = asyncio.Semaphore(max(1, tool_concurrency))
+
+        async def run_call(call) -> tuple[dict, str | None]:
             if call.function.name != "mcp_call_tool":
-                messages.append({
+                return {
                     "role": "tool",
                     "tool_call_id": call.id,
                     "content": "Please use mcp_call_tool to invoke MCP tools."
-                })
-                continue
+                }, None
 
             try:
                 args = json.loads(call.function.arguments or "{}")
                 tool_name = args["tool_name"]
                 arguments = args.get("arguments", {})
             except Exception as e:
-                reply = {
+                return {
                     "role": "tool",
                     "tool_call_id": call.id,
                     "content": f"(error) Invalid JSON in tool call: {e}"
-                }
-                turn_msgs.append(reply)
-                messages.append(reply)
-                continue
+                }, None
 
             # Call the MCP tool
             try:
-                mcp_result = await session.call_tool(tool_name, arguments)
+                async with sem:
+                    mcp_result = await asyncio.wait_for(session.call_tool(tool_name, arguments), tool_timeout_s)
                 tool_text = _pp_content(mcp_result) or "(empty result)"
+            except asyncio.TimeoutError:
+                tool_text = f"(error) {tool_name} timed out after {tool_timeout_s}s"
             except Exception as e:
                 tool_text = f"(error) {e}"
 
-            last_tool_text = tool_text
-            tool_reply = {
+            return {
                 "role": "tool",
                 "tool_call_id": call.id,
                 "content": tool_text
-            }
+            }, tool_text
+
+        for tool_reply, tool_text in await asyncio.gather(*[run_call(call) for call in msg.tool_calls]):
+            if tool_text is not None:
+                last_tool_text = tool_text
             turn_msgs.append(tool_reply)
             messages.append(tool_reply)
 
         continue
-    updated = _append_history(history, turn_msgs, keep_last=keep_last)
-    return (last_tool_text or "Ran out of steps without an answer"), updated
+    if log is not None:
+        log.append(turn_msgs, system=system_msg)
+    history.extend(turn_msgs)
+    return (last_tool_text or "Ran out of steps without an answer"), history
+
+
+async def _ainput(prompt: str) -> str:
+    '''
+    input() on a daemon thread. Unlike asyncio.to_thread, a pending read does not keep
+    the default executor (and so asyncio.run) from shutting down on Ctrl+C.
+    '''
+    loop = asyncio.get_running_loop()
+    fut = loop.create_future()
+
+    def settle(value, exc) -> None:
+        if not fut.done():
+            fut.set_exception(exc) if exc is not None else fut.set_result(value)
+
+    def read() -> None:
+        try:
+            value, exc = input(prompt), None
+        except BaseException as e:
+            # EOFError on a closed stdin
+            value, exc = None, e
+        try:
+            loop.call_soon_threadsafe(settle, value, exc)
+        except RuntimeError:
+            # the loop is gone already
+            pass
+
+    threading.Thread(target=read, name="chat-input", daemon=True).start()
+    return await fut
 
 
 class Client:
-    __slots__ = ('session', 'exit_stack', 'open_ai', '_sessions', '_tool_index')
+    __slots__ = ('session', 'exit_stack', 'open_ai', '_sessions', '_tool_index', '_manifest', '_stale', '_log', '_results',
+                 '_specs', '_owners', '_connecting', 'startup_ms')
     def __init__(self) -> None:
         #self.session: ClientSession | None = None
         self.session = None
         self.exit_stack = AsyncExitStack()
-        self.open_ai = OpenAI(api_key=os.getenv("OPEN_AI_KEY"))
+        self.open_ai = AsyncOpenAI(api_key=os.getenv("OPEN_AI_KEY"))
 
         self._sessions : dict[str, ClientSession] = {}
         self._tool_index : dict[str, tuple[str,str]] = {}
+        self._manifest = ToolManifest()
+        # prefixes whose server announced a tools/list_changed since they were indexed
+        self._stale : set[str] = set()
+        self._log : HistoryLog | None = None
+        self._results = ToolResultCache(TOOL_CACHE, TOOL_CACHE_MAX)
+        # prefix -> how to open it, the task that owns its connection, a connect in progress
+        self._specs : dict[str, tuple[str, dict]] = {}
+        self._owners : dict[str, tuple[asyncio.Task, asyncio.Event]] = {}
+        self._connecting : dict[str, asyncio.Task] = {}
+        self.startup_ms : dict[str, float] = {}
+
+    async def _reindex(self, prefix: str):
+        tools = (await self._sessions[prefix].list_tools()).tools or []
+        self._set_tools(prefix, [t.name for t in tools])
+        self._save_tools(prefix)
+        self._stale.discard(prefix)
+        self._manifest.invalidate()
+        # the server's tools changed, so may their results
+        self._results.invalidate(prefix)
+
+    def _set_tools(self, prefix: str, names: list[str]):
+        for name in [k for k, v in self._tool_index.items() if v[0] == prefix]:
+            del self._tool_index[name]
+        for name in names:
+            self._tool_index[f"{prefix}.{name}"] = (prefix, name)
+
+    def _spec_key(self, prefix: str) -> str:
+        # a cached tool list only counts for the same command / url
+        kind, spec = self._specs[prefix]
+        return hashlib.sha256(json.dumps([kind, spec], sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+    def _load_tools(self, prefix: str) -> list[str] | None:
+        try:
+            entry = json.loads(Path(TOOLS_CACHE_PATH).read_text(encoding="utf-8")).get(prefix) or {}
+        except (OSError, ValueError):
+            return None
+        return entry.get("tools") if entry.get("key") == self._spec_key(prefix) else None
+
+    def _save_tools(self, prefix: str):
+        if prefix not in self._specs:
+            return
+        path = Path(TOOLS_CACHE_PATH)
+        try:
+            data = json.loads(path.read_text(encoding="utf-8")) if path.exists() else {}
+        except (OSError, ValueError):
+            data = {}
+        data[prefix] = {
+            "key": self._spec_key(prefix),
+            "tools": sorted(name for p, name in self._tool_index.values() if p == prefix),
+        }
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_suffix(".tmp")
+            tmp.write_text(json.dumps(data, indent=2), encoding="utf-8")
+            os.replace(tmp, path)
+        except OSError as e:
+            print(f"[{prefix}] could not save the tool list: {e}")
+
+    def _handler(self, prefix: str | None):
+        # remember which server changed, its tools are re-listed on the next turn
+        return self._manifest.message_handler(None if prefix is None else lambda: self._stale.add(prefix))
+        
+    async def _open(self, prefix: str) -> ClientSession:
+        '''
+        Start the server's transport + session in a task of its own. anyio cancel scopes
+        must be exited by the task that entered them, so the owner task keeps the
+        connection open until cleanup() tells it to stop; this lets servers be opened
+        concurrently or from inside a tool call.
+        '''
+        kind, spec = self._specs[prefix]
+        ready = asyncio.get_running_loop().create_future()
+        stop = asyncio.Event()
 
-    async def _index(self, prefix: str, sess: ClientSession):
-        if prefix in self._sessions:
-            raise ValueError(f"prefix '{prefix}' already registered")
+        async def own():
+            try:
+                async with AsyncExitStack() as stack:
+                    if kind == "http":
+                        read, write, _ = await stack.enter_async_context(streamablehttp_client(url=spec["url"], headers=spec["headers"]))
+                    else:
+                        read, write = await stack.enter_async_context(stdio_client(spec["params"]))
+                    sess = await stack.enter_async_context(ClientSession(read, write, message_handler=self._handler(prefix)))
+                    await sess.initialize()
+                    ready.set_result(sess)
+                    await stop.wait()
+            except asyncio.CancelledError:
+                if not ready.done():
+                    ready.cancel()
+            except BaseException as e:
+                if not ready.done():
+                    ready.set_exception(e)
+                else:
+                    print(f"[{prefix}] connection closed: {type(e).__name__}: {e}")
+
+        task = asyncio.create_task(own(), name=f"mcp-{prefix}")
+        self._owners[prefix] = (task, stop)
+        try:
+            return await ready
+        except BaseException:
+            self._owners.pop(prefix, None)
+            raise
+
+    async def _connect(self, prefix: str) -> ClientSession:
+        t0 = time.perf_counter()
+        sess = await self._open(prefix)
         self._sessions[prefix] = sess
-        tools = (await sess.list_tools()).tools or []
-        for t in tools:
-            self._tool_index[f"{prefix}.{t.name}"] = (prefix, t.name)
+        try:
+            await self._reindex(prefix)
+        except BaseException:
+            # half started: close it again so a later call can retry
+            del self._sessions[prefix]
+            task, stop = self._owners.pop(prefix)
+            stop.set()
+            raise
+        self.startup_ms[prefix] = (time.perf_counter() - t0) * 1000
+        return sess
+
+    async def _session_for(self, prefix: str) -> ClientSession:
+        # lazy servers get connected by the first call that needs them, concurrent calls share the connect
+        sess = self._sessions.get(prefix)
+        if sess is not None:
+            return sess
+        pending = self._connecting.get(prefix)
+        if pending is not None:
+            return await asyncio.shield(pending)
+        pending = asyncio.create_task(self._connect(prefix))
+        self._connecting[prefix] = pending
+        pending.add_done_callback(lambda _: self._connecting.pop(prefix, None))
+        sess = await asyncio.shield(pending)
+        print(f"\n[{prefix}] started on first use in {self.startup_ms[prefix]:.0f} ms")
+        return sess
+
+    async def _register(self, prefix: str, kind: str, spec: dict, lazy: bool | None):
+        if prefix in self._specs:
+            raise ValueError(f"prefix '{prefix}' already registered")
+        self._specs[prefix] = (kind, spec)
         self.session = self
-        
-    async def register_http(self, prefix: str, url: str, headers:dict|None={}):
-        read, write, _ = await self.exit_stack.enter_async_context(streamablehttp_client(url=url, headers=headers))
-        session = await self.exit_stack.enter_async_context(ClientSession(read, write))
-        await session.initialize()
-        await self._index(prefix, session)
+        if lazy is None:
+            lazy = prefix in LAZY_SERVERS or "*" in LAZY_SERVERS
+        tools = self._load_tools(prefix) if lazy else None
+        if tools is not None:
+            self._set_tools(prefix, tools)
+            self._manifest.invalidate()
+            self.startup_ms[prefix] = 0.0
+            print(f"[{prefix}] deferred, {len(tools)} tools from the last run")
+            return
+        # no tool list from a previous run (or not lazy): connect now
+        await self._connect(prefix)
+        print(f"[{prefix}] ready in {self.startup_ms[prefix]:.0f} ms ({sum(v[0] == prefix for v in self._tool_index.values())} tools)")
+
+    async def register_http(self, prefix: str, url: str, headers:dict|None={}, lazy: bool | None = None):
+        await self._register(prefix, "http", {"url": url, "headers": headers}, lazy)
     
-    async def register_stdio(self, prefix: str, params: StdioServerParameters):
-        read, write = await self.exit_stack.enter_async_context(stdio_client(params))
-        sess = await self.exit_stack.enter_async_context(ClientSession(read, write))
-        await sess.initialize()
-        await self._index(prefix, sess)
+    async def register_stdio(self, prefix: str, params: StdioServerParameters, lazy: bool | None = None):
+        await self._register(prefix, "stdio", {"params": params}, lazy)
+
+    async def register_all(self, servers: list[tuple]):
+        '''
+        Register servers concurrently: [("fs", "stdio", params), ("gh", "http", url, headers), ...].
+        A server that fails to start is reported and left out.
+        '''
+        async def one(prefix, kind, *args):
+            if kind == "http":
+                await self.register_http(prefix, *args)
+            else:
+                await self.register_stdio(prefix, *args)
+
+        t0 = time.perf_counter()
+        results = await asyncio.gather(*[one(*s) for s in servers], return_exceptions=True)
+        for s, res in zip(servers, results):
+            if isinstance(res, BaseException):
+                print(f"[{s[0]}] failed to start: {type(res).__name__}: {res}")
+                self._specs.pop(s[0], None)
+        print(f"Servers registered in {(time.perf_counter() - t0) * 1000:.0f} ms")
 
     # redirect tool listing correctly depending of the server
     async def list_tools(self):
-        
+        for prefix in list(self._stale):
+            await self._reindex(prefix)
         return SimpleNamespace(
             tools=[
                 SimpleNamespace(
@@ -286,7 +581,11 @@ class Client:
     # redirect tool calls depending of the server
     async def call_tool(self, tool_name: str, arguments: dict):
         prefix, plain = self._tool_index[tool_name]
-        return await self._sessions[prefix].call_tool(plain, arguments)
+
+        async def fetch():
+            return await (await self._session_for(prefix)).call_tool(plain, arguments)
+
+        return await self._results.call(prefix, plain, arguments, fetch)
 
 
     async def connect_to_local_server(self, root_path:str=None, personal_server: bool= True):
@@ -301,14 +600,16 @@ class Client:
             server_params = StdioServerParameters(command="npx",args=["-y", "@modelcontextprotocol/server-filesystem", root_path])
         
         read,write = await self.exit_stack.enter_async_context(stdio_client(server_params))
-        self.session = await self.exit_stack.enter_async_context(ClientSession(read, write))
+        self.session = await self.exit_stack.enter_async_context(ClientSession(read, write, message_handler=self._handler(None)))
         await self.session.initialize()
+        self._manifest.invalidate()
         
 
     async def connect_to_remote_server(self, url:str, headers:dict|None=None):
         read, write, _ = await self.exit_stack.enter_async_context(streamablehttp_client(url=url, headers=headers or {}))
-        self.session = await self.exit_stack.enter_async_context(ClientSession(read, write))
+        self.session = await self.exit_stack.enter_async_context(ClientSession(read, write, message_handler=self._handler(None)))
         await self.session.initialize()
+        self._manifest.invalidate()
     
 
             
@@ -317,17 +618,39 @@ class Client:
         '''
         Provides chat interface to generate questions and responses
         '''
-        history: list[dict] = []
+        history = HistoryWindow(HISTORY_TOKENS)
+        if LOG_RESUME_LAST > 0:
+            # read through the offset index before the writer opens, only the tail gets parsed
+            history = HistoryWindow(HISTORY_TOKENS, HistoryReader(LOG_PATH).tail(LOG_RESUME_LAST))
+            if len(history):
+                print(f"Resumed {len(history)} messages from {LOG_PATH}")
+        if self._log is None:
+            self._log = HistoryLog(LOG_PATH, max_bytes=LOG_MAX_BYTES, fsync=LOG_FSYNC,
+                                   fsync_interval_s=LOG_FSYNC_INTERVAL_S, flush_every=LOG_FLUSH_EVERY)
         while True:
             try:
-                query = str(input("\nAsk something to chat: ").strip())
+                # read the prompt off the event loop, the MCP sessions stay alive while we wait
+                query = (await _ainput("\nAsk something to chat: ")).strip()
                 if query == "exit":
                     break
-                answer, history = await small_chat(self.session, self.open_ai, query, history=history)
-                print("\nAgent: " + answer)
-                save_history_jsonl(history=history, path="chat_logs/log.jsonl")
-            except KeyboardInterrupt:
-                print(f"Session ended by keyboard interruption")
+                streamed = []
+                def on_token(token: str) -> None:
+                    if not streamed:
+                        print("\nAgent: ", end="", flush=True)
+                    streamed.append(token)
+                    print(token, end="", flush=True)
+                answer, history = await small_chat(self.session, self.open_ai, query, history=history,
+                                                   manifest=self._manifest, on_token=on_token, log=self._log)
+                if streamed:
+                    print()
+                    # the model went quiet and we fell back to the last tool output
+                    if not "".join(streamed).strip().endswith(answer.strip()):
+                        print("\nAgent: " + answer)
+                else:
+                    print("\nAgent: " + answer)
+            except asyncio.CancelledError:
+                # Ctrl+C: asyncio.run cancels the main task, leave so main() can clean up
+                print(f"\nSession ended by keyboard interruption")
                 break
 
             except Exception as exc:
@@ -335,6 +658,15 @@ class Client:
                 break
                 
     async def cleanup(self) -> None:
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+        for task in list(self._connecting.values()):
+            task.cancel()
+        for task, stop in self._owners.values():
+            stop.set()
+        await asyncio.gather(*[task for task, _ in self._owners.values()], return_exceptions=True)
+        self._owners.clear()
         await self.exit_stack.aclose()
 
 
@@ -357,8 +689,10 @@ async def main(server_indication:str="filesystem"):
             )
         GITHUB_TOKEN = os.getenv("GITHUB_TOKEN")
         if server_indication == "filesystem":
-            await client.register_stdio("fs", fs_params)
-            await client.register_http(prefix = "gh",url="https://api.githubcopilot.com/mcp/", headers={"Authorization" : f"Bearer {GITHUB_TOKEN}"})
+            await client.register_all([
+                ("fs", "stdio", fs_params),
+                ("gh", "http", "https://api.githubcopilot.com/mcp/", {"Authorization" : f"Bearer {GITHUB_TOKEN}"}),
+            ])
         else:
             await client.connect_to_local_server(personal_server=True)
         # await client.register_http(prefix="cloud", url = "http://18.191.243.65:8000/mcp", headers={})
@@ -374,7 +708,10 @@ def run() -> None:
     print("### Client ###")
     print("Local & Remote | Filesystem & Github")
     indication: str = str(input("Enter mode: "))
-    asyncio.run(main(server_indication=indication))
+    try:
+        asyncio.run(main(server_indication=indication))
+    except KeyboardInterrupt:
+        pass
 
 if __name__ == '__main__':
     run()
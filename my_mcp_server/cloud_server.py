@@ -1,40 +1,192 @@
-import httpx
-from typing import Any, Optional
 from mcp.server.fastmcp import FastMCP
-import json
+from collections import deque
+from contextlib import asynccontextmanager, suppress
+from datetime import datetime, timezone
+from typing import AsyncIterator, Literal
 import asyncio
+import json
 import logging
+import os
+import numpy as np
 from pydantic import BaseModel
+import orbit
+import tle_catalog
+import upstream
+from upstream import make_request
 
-mcp = FastMCP(name="CloudServer")
 SATELLITE_API = "https://tle.ivanstanojevic.me/api"
-# for some reason it only works with this
-DEFAULT_HEADERS = {
-    "Accept": "application/json",
-    "User-Agent": "Mozilla/5.0 (compatible; mcp-client/1.0; +https://example.com)",
-    "Connection": "close",
-}
+# local TLE catalog, TLE_CATALOG=0 sends every search to the API
+TLE_CATALOG = os.getenv("TLE_CATALOG", "1") == "1"
+TLE_CATALOG_DB = os.getenv("TLE_CATALOG_DB", ":memory:")
+TLE_CATALOG_REFRESH_S = float(os.getenv("TLE_CATALOG_REFRESH_S", "21600"))
+# most records a search returns, broad names like "STARLINK" match thousands
+TLE_SEARCH_LIMIT = int(os.getenv("TLE_SEARCH_LIMIT", "1000"))
+# remote searches read at most this many pages, TLE_PAGE_WORKERS of them at a time
+TLE_MAX_PAGES = int(os.getenv("TLE_MAX_PAGES", "10"))
+TLE_PAGE_WORKERS = int(os.getenv("TLE_PAGE_WORKERS", "4"))
+TLE_PAGE_SIZE = 100
+# propagate_orbits bounds: satellites per call and satellites x time steps
+ORBIT_MAX_SATELLITES = int(os.getenv("ORBIT_MAX_SATELLITES", "5000"))
+ORBIT_MAX_POINTS = int(os.getenv("ORBIT_MAX_POINTS", "2000000"))
+# CLOUD_WORKERS > 1 serves streamable-http from that many processes (see run_workers)
+CLOUD_WORKERS = int(os.getenv("CLOUD_WORKERS", "1"))
+CLOUD_GRACEFUL_TIMEOUT_S = float(os.getenv("CLOUD_GRACEFUL_TIMEOUT_S", "30"))
+CLOUD_STATE_DIR = os.getenv("CLOUD_STATE_DIR", ".cache")
+
+catalog = tle_catalog.TleCatalog(TLE_CATALOG_DB) if TLE_CATALOG else None
+_catalog_task: asyncio.Task | None = None
+# sessions inside the lifespan, the refresh task runs while there is at least one
+# (streamable-http enters the lifespan once per session, like upstream.lifespan)
+_catalog_users = 0
+satrecs = orbit.SatrecCache()
+
+
+@asynccontextmanager
+async def lifespan(server):
+    '''
+    Shared HTTP client plus the background task refreshing the TLE catalog
+    '''
+    global _catalog_task, _catalog_users
+    async with upstream.lifespan(server):
+        _catalog_users += 1
+        if catalog is not None and _catalog_task is None:
+            _catalog_task = asyncio.create_task(tle_catalog.keep_fresh(
+                catalog, lambda: _tle_pages({"sort": "id", "sort-dir": "asc"}), TLE_CATALOG_REFRESH_S
+            ))
+        try:
+            yield
+        finally:
+            _catalog_users -= 1
+            if _catalog_users == 0 and _catalog_task is not None:
+                task, _catalog_task = _catalog_task, None
+                task.cancel()
+                with suppress(asyncio.CancelledError):
+                    await task
+
+mcp = FastMCP(name="CloudServer", lifespan=lifespan)
+
+
+def _tle_ttl(params: dict) -> float:
+    # TLE sets are republished a few times a day at most. Catalog pages are read once
+    # per refresh, caching them would only push searches out of the LRU
+    if "page" in params and "search" not in params:
+        return 0
+    return 3600
+
+upstream.cache.set_ttl(SATELLITE_API, _tle_ttl)
+
+
+async def _tle_pages(params: dict, max_pages: int | None = None) -> AsyncIterator[list[dict]]:
+    '''
+    Yield the "member" list of every page of a TLE collection query, in page order.
+    The first page tells how many there are; the rest are fetched by a sliding window
+    of TLE_PAGE_WORKERS requests, so at most that many pages are held at once. A page
+    that cannot be fetched, or comes back empty before the page count from page 1,
+    raises upstream.StreamError after the pages before it, so returning normally means
+    every page was read.
+    '''
+    url = f"{SATELLITE_API}/tle/"
+
+    async def fetch(page: int) -> dict | None:
+        return await make_request(url, params={**params, "page": page, "page-size": TLE_PAGE_SIZE})
+
+    first = await fetch(1)
+    if not isinstance(first, dict):
+        raise upstream.StreamError("TLE API page 1 unavailable")
+    members = first.get("member") or []
+    total = int(first.get("totalItems") or 0)
+    yield members
+    if members and not total:
+        # no way to tell how far the collection goes
+        raise upstream.StreamError("TLE API page 1 has no totalItems")
+    pages = -(-total // TLE_PAGE_SIZE)
+    if max_pages is not None:
+        pages = min(pages, max_pages)
+
+    pending: deque[tuple[int, asyncio.Future]] = deque()
+    next_page = 2
+    try:
+        while pending or next_page <= pages:
+            while next_page <= pages and len(pending) < TLE_PAGE_WORKERS:
+                pending.append((next_page, asyncio.ensure_future(fetch(next_page))))
+                next_page += 1
+            page, fut = pending.popleft()
+            data = await fut
+            if not isinstance(data, dict):
+                raise upstream.StreamError(f"TLE API page {page} unavailable")
+            members = data.get("member") or []
+            if not members:
+                # the collection shrank under us or the API cut the walk short, either
+                # way the pages after this one were not read
+                raise upstream.StreamError(f"TLE API page {page} of {pages} came back empty")
+            yield members
+    finally:
+        # the caller stopped early (or a page failed): cancel the pages still in flight,
+        # make_request stops a fetch once nobody is waiting for it
+        for _, fut in pending:
+            fut.cancel()
+
 class Satellite(BaseModel):
     id: str
     name: str
 
 
+class OrbitQuery(BaseModel):
+    # satellites by id and/or every match of a name search
+    ids: list[str] = []
+    name: str | None = None
+    # ISO-8601 start (UTC when no offset is given), defaults to now
+    start: str | None = None
+    step_s: float = 60
+    steps: int = 60
+    frame: Literal["geodetic", "teme"] = "geodetic"
+    precision: int = 3
+
+
+async def _search_members(name: str, limit: int = TLE_SEARCH_LIMIT) -> AsyncIterator[dict]:
+    '''
+    Records matching name, from the catalog once a full refresh pass has completed,
+    otherwise streamed page by page from the API (up to TLE_MAX_PAGES pages)
+    '''
+    if catalog is not None and catalog.ready:
+        for m in catalog.search(name, limit=limit):
+            yield m
+        return
+    async for members in _tle_pages({"search": name}, TLE_MAX_PAGES):
+        for m in members:
+            yield m
+
+async def _lookup(sat_id: str) -> dict | None:
+    data = catalog.get(sat_id) if catalog is not None else None
+    if data is None:
+        data = await make_request(url=f"{SATELLITE_API}/tle/{sat_id}")
+        if not isinstance(data, dict):
+            return None
+        if catalog is not None:
+            catalog.upsert([data])
+    return data
+
 @mcp.tool()
 async def search_satellites(input: Satellite) -> dict:    
     '''
     Searches information from a satellite
     '''
-    url = f"{SATELLITE_API}/tle/"  
-
-    data = await make_request(url=url, params={"search": input.name})
-    if not isinstance(data, dict):
-        return {}
-    
-    members = data.get("member", [])
-    if not members:
+    data = []
+    records = _search_members(input.name)
+    try:
+        async for m in records:
+            data.append(format_information(m))
+            if len(data) >= TLE_SEARCH_LIMIT:
+                break
+    except upstream.StreamError as e:
+        if not data:
+            return {}
+        # keep what arrived, but say it is partial
+        data.append(f"Results incomplete: {e}")
+    finally:
+        await records.aclose()
+    if not data:
         return f"No members found"
-    
-    data = await asyncio.gather(*[format_information(m) for m in members])
     return data
 
 @mcp.tool()
@@ -42,50 +194,94 @@ async def search_satellite_by_id(input: Satellite) -> dict:
     '''
     Gets information from a satellite using the ID
     '''
-    url = f"{SATELLITE_API}/tle/{input.id}"
-    data = await make_request(url=url)
-    if  not isinstance(data, dict):
+    data = await _lookup(input.id)
+    if data is None:
         return {}
-    data = await asyncio.gather(format_information(data))
+    data = [format_information(data)]
     logging.info("Using tool search_satellite_by_id")
     return data
 
-async def make_request(url: str, params: Optional[dict[str, Any]] = None) -> dict[str, Any] | None:
+def _rows(values: np.ndarray, precision: int, ok: np.ndarray) -> list:
+    # one JSON list per satellite, failed propagation steps become null
+    out = np.round(values, precision).tolist()
+    for i in np.flatnonzero(~ok.all(axis=1)):
+        out[i] = [v if good else None for v, good in zip(out[i], ok[i])]
+    return out
+
+@mcp.tool()
+async def propagate_orbits(input: OrbitQuery) -> dict:
     '''
-    Helper function to make requests to the API
+    Positions of many satellites over a time grid (SGP4), picked by ids and/or a name
+    search. frame="geodetic" gives lat/lon in degrees and alt_km, "teme" gives x/y/z in km.
     '''
-    async with httpx.AsyncClient(                    
-        timeout=httpx.Timeout(25.0),
-        headers=DEFAULT_HEADERS,
-        transport=httpx.AsyncHTTPTransport(retries=2),               
-        follow_redirects=True,
-    ) as client:
+    if not orbit.can_propagate():
+        return {"error": "orbit propagation needs the sgp4 package (pip install .[orbit])"}
+    if input.steps < 1 or input.step_s <= 0:
+        return {"error": "steps must be >= 1 and step_s > 0"}
+    # every id can be an API lookup, refuse oversized requests before making any
+    if len(input.ids) > ORBIT_MAX_SATELLITES:
+        return {"error": f"{len(input.ids)} ids is over the limit of {ORBIT_MAX_SATELLITES} satellites"}
+    try:
+        start = datetime.fromisoformat(input.start) if input.start else datetime.now(timezone.utc)
+    except ValueError:
+        return {"error": f"bad start time {input.start!r}"}
+
+    members, not_found = [], []
+    for sat_id, m in zip(input.ids, await asyncio.gather(*[_lookup(i) for i in input.ids])):
+        if m is None:
+            not_found.append(sat_id)
+        else:
+            members.append(m)
+    if input.name:
         try:
-            response = await client.get(url, params=params)
-            response.raise_for_status()
- 
-            return response.json()
-        except httpx.RemoteProtocolError as e:
-            logging.error("RemoteProtocolError for %s: %r", response.request.url if 'r' in locals() else url, e)
-            return None
-        except httpx.HTTPStatusError as e:
-            resp = e.response
-            logging.error("HTTP %s for %s\nHeaders: %s\nBody: %s",
-                          resp.status_code, resp.request.url, dict(resp.headers), resp.text[:500])
-            return None
-        except json.JSONDecodeError as e:
-            logging.error("JSON decode error for %s: %r (first 200 chars: %s)",
-                          response.request.url if 'r' in locals() else url, e, (response.text[:200] if 'r' in locals() else ""))
-            return None
-        except httpx.RequestError as e:
-            logging.error("RequestError for %s: %r", url, e)
-            return None
-        except Exception as e:
-            logging.error("Unexpected error for %s: %r", url, e)
-            return None
+            async for m in _search_members(input.name, limit=ORBIT_MAX_SATELLITES):
+                members.append(m)
+                if len(members) >= ORBIT_MAX_SATELLITES:
+                    break
+        except upstream.StreamError as e:
+            logging.warning("propagate_orbits: name search incomplete: %s", e)
+
+    sats, meta, seen, bad = [], [], set(), []
+    for m in members:
+        sat_id = m.get("satelliteId")
+        if sat_id in seen:
+            continue
+        seen.add(sat_id)
+        sat = satrecs.get(sat_id, m.get("line1") or "", m.get("line2") or "")
+        if sat is None:
+            bad.append(sat_id)
+            continue
+        sats.append(sat)
+        meta.append((sat_id, m.get("name")))
+    out = {"frame": input.frame, "satellites": [], "not_found": not_found, "unparseable": bad}
+    if not sats:
+        return out
+    if len(sats) > ORBIT_MAX_SATELLITES:
+        return {"error": f"{len(sats)} satellites is over the limit of {ORBIT_MAX_SATELLITES} satellites"}
+    if len(sats) * input.steps > ORBIT_MAX_POINTS:
+        return {"error": f"{len(sats)} satellites x {input.steps} steps is over the limit of {ORBIT_MAX_POINTS} points"}
+
+    jd, fr = orbit.time_grid(start, input.step_s, input.steps)
+    err, r, _ = orbit.propagate(sats, jd, fr)
+    ok = err == 0
+    epoch = (jd - orbit.UNIX_EPOCH_JD + fr) * 86400.0
+    out["times"] = [datetime.fromtimestamp(t, timezone.utc).isoformat(timespec="seconds") for t in epoch]
 
-        
-async def format_information(member: dict) -> list[str]:
+    if input.frame == "geodetic":
+        lat, lon, alt = orbit.teme_to_geodetic(r, jd, fr)
+        cols = {"lat": _rows(lat, input.precision, ok), "lon": _rows(lon, input.precision, ok),
+                "alt_km": _rows(alt, input.precision, ok)}
+    else:
+        cols = {k: _rows(r[..., i], input.precision, ok) for i, k in enumerate(("x_km", "y_km", "z_km"))}
+    for i, (sat_id, name) in enumerate(meta):
+        row = {"satelliteId": sat_id, "name": name, **{k: v[i] for k, v in cols.items()}}
+        if not ok[i].all():
+            # sgp4 error code of the first failed step (decayed, eccentricity out of range...)
+            row["sgp4_error"] = int(err[i][~ok[i]][0])
+        out["satellites"].append(row)
+    return out
+
+def format_information(member: dict) -> str:
     """
     Format TLE in a nice way
     """
@@ -104,7 +300,74 @@ async def format_information(member: dict) -> list[str]:
     )
 
 
+@mcp.resource("stats://upstream")
+def upstream_stats() -> str:
+    """Cache and request-coalescing counters for the TLE upstream."""
+    return json.dumps(upstream.stats(), indent=2)
+
+
+@mcp.resource("stats://tle-catalog")
+def tle_catalog_stats() -> str:
+    """Size and freshness of the local TLE catalog."""
+    return json.dumps(catalog.stats() if catalog is not None else {"enabled": False}, indent=2)
+
+
+@mcp.resource("stats://orbit")
+def orbit_stats() -> str:
+    """Parsed-TLE cache counters for propagate_orbits."""
+    return json.dumps(satrecs.stats(), indent=2)
+
+
+def create_app():
+    '''
+    ASGI app for one worker process of the multi-worker mode (a uvicorn factory)
+    '''
+    # a session lives in one process, so with several workers every request has to stand alone
+    mcp.settings.stateless_http = True
+    app = mcp.streamable_http_app()
+    sessions = app.router.lifespan_context
+
+    @asynccontextmanager
+    async def worker_lifespan(app):
+        # stateless requests enter the server lifespan one by one, holding it for the
+        # whole worker keeps the pooled client and the catalog task alive between them
+        async with lifespan(mcp), sessions(app):
+            yield
+
+    app.router.lifespan_context = worker_lifespan
+    return app
+
+
+def run_workers(workers: int) -> None:
+    '''
+    Serve streamable-http from `workers` processes behind one port. Workers share the
+    upstream response cache and the TLE catalog through SQLite files in CLOUD_STATE_DIR
+    (unless MCP_CACHE_DB / TLE_CATALOG_DB say otherwise), and only one of them refreshes
+    the catalog at a time. Upstream rate limits are divided between the workers. SIGINT/SIGTERM drain in-flight requests for up to
+    CLOUD_GRACEFUL_TIMEOUT_S before the workers exit.
+    '''
+    import uvicorn
+
+    # the workers import this module again, the environment is how they get the paths
+    os.environ.setdefault("MCP_CACHE_DB", os.path.join(CLOUD_STATE_DIR, "upstream_cache.db"))
+    os.environ.setdefault("TLE_CATALOG_DB", os.path.join(CLOUD_STATE_DIR, "tle_catalog.db"))
+    # each worker has its own token buckets, split the per-host rates between them
+    os.environ.setdefault("MCP_RATE_SHARES", str(workers))
+    uvicorn.run(
+        "cloud_server:create_app",
+        factory=True,
+        host=mcp.settings.host,
+        port=mcp.settings.port,
+        workers=workers,
+        timeout_graceful_shutdown=CLOUD_GRACEFUL_TIMEOUT_S,
+        log_level=mcp.settings.log_level.lower(),
+    )
+
+
 def main():
+    if CLOUD_WORKERS > 1:
+        run_workers(CLOUD_WORKERS)
+        return
     try:
         mcp.run(
             transport="streamable-http"
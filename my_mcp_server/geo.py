@@ -0,0 +1,115 @@
+'''
+Great-circle helpers shared by the hazard tools.
+
+The scalar haversine is the reference implementation; the NumPy versions compute
+whole batches of points at once and resolve near-ties with the scalar one so the
+results are identical to looping point by point.
+'''
+import math
+import numpy as np
+
+
+EARTH_RADIUS_KM = 6371.0
+# numpy and math trig can disagree in the last ulp, anything this close is re-checked exactly
+_TIE_EPS_KM = 1e-6
+_TIE_EPS_DEG = 1e-6
+
+
+def haversine_km(a: tuple, b: tuple) -> float:
+    # a=(lat,lon), b=(lat,lon)
+    R=EARTH_RADIUS_KM
+    dlat=math.radians(b[0]-a[0])
+    dlon=math.radians(b[1]-a[1])
+    s = (math.sin(dlat/2)**2 + math.cos(math.radians(a[0]))*math.cos(math.radians(b[0]))*math.sin(dlon/2)**2)
+    return 2*R*math.asin(math.sqrt(s))
+
+
+def haversine_km_np(lat: float, lon: float, lats: np.ndarray, lons: np.ndarray) -> np.ndarray:
+    '''
+    Distances from (lat, lon) to every (lats[i], lons[i]), same formula as haversine_km
+    '''
+    dlat = np.radians(lats - lat)
+    dlon = np.radians(lons - lon)
+    s = np.sin(dlat/2)**2 + math.cos(math.radians(lat))*np.cos(np.radians(lats))*np.sin(dlon/2)**2
+    return 2*EARTH_RADIUS_KM*np.arcsin(np.sqrt(s))
+
+
+def nearest_per_group(
+    lat: float,
+    lon: float,
+    lats: np.ndarray,
+    lons: np.ndarray,
+    groups: np.ndarray,
+    n_groups: int,
+    max_km: float | None = None,
+) -> tuple[np.ndarray, np.ndarray]:
+    '''
+    For points flattened into contiguous arrays and tagged with a non-decreasing group
+    id, return (index of the nearest point, its distance) per group. Groups without
+    points, or whose nearest point is farther than max_km, get index -1 and NaN.
+
+    Ties go to the first point of the group, like a strict '<' scan would.
+    '''
+    best_idx = np.full(n_groups, -1, dtype=np.int64)
+    best_dist = np.full(n_groups, np.nan)
+    if len(lats) == 0:
+        return best_idx, best_dist
+
+    d = haversine_km_np(lat, lon, lats, lons)
+
+    # grouped min over contiguous runs
+    present, starts = np.unique(groups, return_index=True)
+    mins = np.minimum.reduceat(d, starts)
+    if max_km is not None:
+        keep = mins <= max_km + _TIE_EPS_KM
+        present, starts, mins = present[keep], starts[keep], mins[keep]
+        if len(present) == 0:
+            return best_idx, best_dist
+
+    group_min = np.full(n_groups, -np.inf)
+    group_min[present] = mins
+    candidates = np.flatnonzero(d <= group_min[groups] + _TIE_EPS_KM)
+    cand_groups = groups[candidates]
+
+    # one candidate per group is the common case, only near-ties need the exact scalar pass
+    uniq, first, counts = np.unique(cand_groups, return_index=True, return_counts=True)
+    best_idx[uniq] = candidates[first]
+    for g, start, count in zip(uniq[counts > 1], first[counts > 1], counts[counts > 1]):
+        best, bd = -1, None
+        for i in candidates[start:start + count]:
+            di = haversine_km((lat, lon), (lats[i], lons[i]))
+            if bd is None or di < bd:
+                best, bd = i, di
+        best_idx[g] = best
+
+    chosen = best_idx[uniq]
+    best_dist[uniq] = [haversine_km((lat, lon), (lats[i], lons[i])) for i in chosen]
+    if max_km is not None:
+        far = best_dist > max_km
+        best_idx[far] = -1
+        best_dist[far] = np.nan
+    return best_idx, best_dist
+
+
+def bounding_boxes(lat: float, lon: float, radius_km: float) -> list[tuple[float, float, float, float]]:
+    '''
+    (min_lon, min_lat, max_lon, max_lat) boxes covering the circle of radius_km around
+    (lat, lon). A circle crossing the antimeridian is split in two boxes, one reaching
+    a pole covers every longitude.
+    '''
+    ang = radius_km / EARTH_RADIUS_KM
+    dlat = math.degrees(ang) + _TIE_EPS_DEG
+    min_lat, max_lat = lat - dlat, lat + dlat
+    if min_lat <= -90.0 or max_lat >= 90.0 or ang >= math.pi / 2:
+        return [(-180.0, max(min_lat, -90.0), 180.0, min(max_lat, 90.0))]
+
+    # widest longitude extent of a spherical cap, reached off the centre latitude
+    dlon = math.degrees(math.asin(min(1.0, math.sin(ang) / math.cos(math.radians(lat))))) + _TIE_EPS_DEG
+    if dlon >= 180.0:
+        return [(-180.0, min_lat, 180.0, max_lat)]
+    min_lon, max_lon = lon - dlon, lon + dlon
+    if min_lon < -180.0:
+        return [(min_lon + 360.0, min_lat, 180.0, max_lat), (-180.0, min_lat, max_lon, max_lat)]
+    if max_lon > 180.0:
+        return [(min_lon, min_lat, 180.0, max_lat), (-180.0, min_lat, max_lon - 360.0, max_lat)]
+    return [(min_lon, min_lat, max_lon, max_lat)]
@@ -0,0 +1,245 @@
+'''
+In-memory spatial index over EONET events.
+
+Event points are bucketed into a lat/lon grid so a radius query only looks at the
+handful of cells the search circle touches. A background task keeps the index
+fresh by re-fetching only the last couple of days of the feed and upserting the
+events by id, so list_hazards can answer from memory instead of the network.
+'''
+from datetime import date, timedelta
+from typing import Any, Awaitable, Callable
+import asyncio
+import logging
+import math
+import sys
+import time
+import geo
+
+
+def _day(value) -> str | None:
+    # EONET dates are ISO timestamps, the index only cares about the day
+    return value[:10] if isinstance(value, str) and len(value) >= 10 else None
+
+
+class HazardIndex:
+    '''
+    Grid bucket index of EONET event points.
+
+    Every event is stored once and referenced from each cell one of its Point
+    geometries falls into. query() returns candidate events in feed order (newest
+    activity first); the exact nearest-point math stays with the caller so answers
+    match the network path.
+    '''
+    def __init__(self, cell_deg: float = 1.0, max_age_s: float = 3600) -> None:
+        self.cell_deg = cell_deg
+        # older than this (refreshes failing, EONET down) the index is not trusted any more
+        self.max_age_s = max_age_s
+        self._events: dict[Any, dict] = {}
+        self._spans: dict[Any, tuple[str, str]] = {}
+        self._event_cells: dict[Any, set[tuple[int, int]]] = {}
+        self._event_points: dict[Any, int] = {}
+        self._cells: dict[tuple[int, int], set] = {}
+        self._n_lon_cells = int(math.ceil(360.0 / cell_deg))
+        self.covered_from: str | None = None
+        self.covered_to: str | None = None
+        self.points = 0
+        self.build_ms: float | None = None
+        self.last_refresh_ms: float | None = None
+        self.last_refresh: float | None = None
+        self.queries = 0
+        self.last_query_ms: float | None = None
+        self._query_ms_total = 0.0
+
+    @property
+    def ready(self) -> bool:
+        return self.covered_from is not None
+
+    def _cell(self, lat: float, lon: float) -> tuple[int, int]:
+        i = int(math.floor((lat + 90.0) / self.cell_deg))
+        j = int(math.floor((lon + 180.0) / self.cell_deg)) % self._n_lon_cells
+        return i, j
+
+    def _remove(self, ev_id) -> None:
+        for cell in self._event_cells.pop(ev_id, ()):
+            bucket = self._cells.get(cell)
+            if bucket is not None:
+                bucket.discard(ev_id)
+                if not bucket:
+                    del self._cells[cell]
+        self._events.pop(ev_id, None)
+        self._spans.pop(ev_id, None)
+        self.points -= self._event_points.pop(ev_id, 0)
+
+    def upsert(self, events: list) -> int:
+        '''
+        Insert or replace events by id, returns how many were indexed
+        '''
+        n = 0
+        for ev in events:
+            if not isinstance(ev, dict) or ev.get("id") is None:
+                continue
+            ev_id = ev["id"]
+            self._remove(ev_id)
+
+            cells, days, n_points = set(), [], 0
+            for g in ev.get("geometry") or []:
+                if not isinstance(g, dict):
+                    continue
+                day = _day(g.get("date"))
+                if day:
+                    days.append(day)
+                coords = g.get("coordinates")
+                if g.get("type") != "Point" or not isinstance(coords, list) or len(coords) < 2:
+                    continue
+                lon, lat = coords[0], coords[1]
+                if isinstance(lat, (int, float)) and isinstance(lon, (int, float)):
+                    cells.add(self._cell(lat, lon))
+                    n_points += 1
+            if not cells:
+                continue
+
+            # ongoing events (closed is null) stay active until today
+            if ev.get("closed") is None:
+                end = "9999-12-31"
+            else:
+                end = _day(ev.get("closed")) or (max(days) if days else "9999-12-31")
+            self._spans[ev_id] = (min(days) if days else "0000-00-00", end)
+            self._events[ev_id] = ev
+            self._event_cells[ev_id] = cells
+            self._event_points[ev_id] = n_points
+            self.points += n_points
+            for cell in cells:
+                self._cells.setdefault(cell, set()).add(ev_id)
+            n += 1
+        return n
+
+    def evict_before(self, day: str) -> None:
+        # drop events that ended before the start of the covered window
+        for ev_id in [k for k, (_, end) in self._spans.items() if end < day]:
+            self._remove(ev_id)
+
+    def covers(self, start_date: str, end_date: str) -> bool:
+        '''
+        Whether a query over the window can be answered from the index: the window lies
+        inside what was fetched (up to today for open-ended windows) and the last
+        refresh is recent enough
+        '''
+        if not self.ready or self.covered_to is None or self.last_refresh is None:
+            return False
+        start, end = start_date[:10], end_date[:10]
+        if not (self.covered_from <= start <= end):
+            return False
+        if self.covered_to < min(end, date.today().isoformat()):
+            return False
+        return time.time() - self.last_refresh <= self.max_age_s
+
+    def _candidate_cells(self, lat: float, lon: float, radius_km: float):
+        for min_lon, min_lat, max_lon, max_lat in geo.bounding_boxes(lat, lon, radius_km):
+            i_lo, j_lo = self._cell(min_lat, min_lon)
+            i_hi, j_hi = self._cell(min(max_lat, 90.0 - 1e-9), min(max_lon, 180.0 - 1e-9))
+            for i in range(i_lo, i_hi + 1):
+                for j in range(j_lo, j_hi + 1):
+                    yield i, j
+
+    def query(self, lat: float, lon: float, radius_km: float, start_date: str, end_date: str) -> list[dict]:
+        '''
+        Events with at least one point in a grid cell touched by the search circle and
+        active between start_date and end_date
+        '''
+        t0 = time.perf_counter()
+        ids = set()
+        for cell in self._candidate_cells(lat, lon, radius_km):
+            bucket = self._cells.get(cell)
+            if bucket:
+                ids |= bucket
+        out = self._active(ids, start_date, end_date)
+
+        ms = (time.perf_counter() - t0) * 1000
+        self.queries += 1
+        self.last_query_ms = ms
+        self._query_ms_total += ms
+        return out
+
+    def window(self, start_date: str, end_date: str) -> list[dict]:
+        '''
+        Every indexed event active between start_date and end_date, for batch callers
+        that filter many locations against the same feed
+        '''
+        return self._active(self._events.keys(), start_date, end_date)
+
+    def _active(self, ids, start_date: str, end_date: str) -> list[dict]:
+        start, end = start_date[:10], end_date[:10]
+        hits = []
+        for ev_id in ids:
+            ev_start, ev_end = self._spans[ev_id]
+            if ev_start <= end and ev_end >= start:
+                hits.append(ev_id)
+        # newest activity first, like the EONET feed
+        hits.sort(key=lambda k: (self._spans[k][1], str(k)), reverse=True)
+        return [self._events[k] for k in hits]
+
+    def size_bytes(self) -> int:
+        # container overhead of the index itself, the event payloads are shared with the feed
+        size = sys.getsizeof(self._cells) + sum(sys.getsizeof(b) for b in self._cells.values())
+        size += sys.getsizeof(self._event_cells) + sum(sys.getsizeof(c) for c in self._event_cells.values())
+        return size + sys.getsizeof(self._spans) + sys.getsizeof(self._events) + sys.getsizeof(self._event_points)
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "ready": self.ready,
+            "covered_from": self.covered_from,
+            "covered_to": self.covered_to,
+            "events": len(self._events),
+            "points": self.points,
+            "cells": len(self._cells),
+            "cell_deg": self.cell_deg,
+            "index_bytes": self.size_bytes(),
+            "build_ms": None if self.build_ms is None else round(self.build_ms, 2),
+            "last_refresh_ms": None if self.last_refresh_ms is None else round(self.last_refresh_ms, 2),
+            "last_refresh_age_s": None if self.last_refresh is None else round(time.time() - self.last_refresh, 1),
+            "queries": self.queries,
+            "last_query_ms": None if self.last_query_ms is None else round(self.last_query_ms, 3),
+            "avg_query_ms": round(self._query_ms_total / self.queries, 3) if self.queries else None,
+        }
+
+
+async def keep_fresh(
+    index: HazardIndex,
+    fetch: Callable[[str, str], Awaitable[list | None]],
+    days: int,
+    interval_s: float,
+    overlap_days: int = 2,
+) -> None:
+    '''
+    Build the index over the last `days` days, then every `interval_s` seconds re-fetch
+    only the trailing `overlap_days` and upsert them. fetch(start, end) returns the
+    EONET event list or None on failure.
+    '''
+    while True:
+        today = date.today()
+        try:
+            t0 = time.perf_counter()
+            if not index.ready:
+                start = (today - timedelta(days=days)).isoformat()
+                events = await fetch(start, today.isoformat())
+                if events is not None:
+                    index.upsert(events)
+                    index.covered_from = start
+                    index.build_ms = (time.perf_counter() - t0) * 1000
+                    logging.info("Hazard index built: %s", index.stats())
+            else:
+                start = (today - timedelta(days=overlap_days)).isoformat()
+                events = await fetch(start, today.isoformat())
+                if events is not None:
+                    index.upsert(events)
+                    index.covered_from = max(index.covered_from, (today - timedelta(days=days)).isoformat())
+                    index.evict_before(index.covered_from)
+            if events is not None:
+                index.covered_to = today.isoformat()
+                index.last_refresh = time.time()
+                index.last_refresh_ms = (time.perf_counter() - t0) * 1000
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error("Hazard index refresh failed: %r", e)
+        await asyncio.sleep(interval_s)
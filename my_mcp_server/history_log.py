@@ -0,0 +1,378 @@
+'''
+Append-only chat history log for the client.
+
+Every turn only appends its own new messages as JSON lines instead of rewriting the
+whole history. Lines are buffered and written in batches, with a configurable fsync
+policy, and the log rolls over to a new numbered segment once the current one gets
+too big. The system message (instructions + full tool manifest) is by far the largest
+message and rarely changes: it is written once to its own file, named after its hash,
+and the log only holds a small {"$system": "<hash>"} reference line whenever it changes.
+
+Next to every segment sits a binary offset index (<segment>.idx, one fixed-size record
+per line: byte offset, turn number, flags and the offset of the system reference in
+force), appended together with the lines. The
+reader memory-maps index and segment, so loading the last N messages or seeking to a
+turn touches only those lines however long the log has grown.
+'''
+from bisect import bisect_left
+from pathlib import Path
+import hashlib
+import json
+import mmap
+import os
+import struct
+import time
+
+
+FSYNC_POLICIES = ("always", "interval", "never")
+
+# index record: byte offset of the line, turn number, flags, offset of the {"$system"} line in force
+_REC = struct.Struct("<QIIQ")
+_SYSTEM_FLAG = 1
+
+
+def _index_path(segment: Path) -> Path:
+    return segment.with_suffix(".idx")
+
+
+def _map(path: Path) -> mmap.mmap | None:
+    # empty files cannot be mapped
+    if not path.exists() or path.stat().st_size == 0:
+        return None
+    with path.open("rb") as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _scan(segment: Path, idx, base_turn: int) -> tuple[int, list[tuple[int, int, int, int]], int]:
+    '''
+    Compare a segment with its index (an mmap of the .idx or None) without changing
+    either: returns how many index records are valid (a torn record, or one pointing
+    past the data, is not), the records missing for the complete lines after them and
+    the last turn number. A turn starts at every user message, numbering goes on from
+    base_turn (the last turn of the previous segment).
+    '''
+    size = segment.stat().st_size if segment.exists() else 0
+    n = len(idx) // _REC.size if idx is not None else 0
+    last_turn, start, system_at = base_turn, 0, 0
+    while n:
+        offset, last_turn, _, system_at = _REC.unpack_from(idx, (n - 1) * _REC.size)
+        if offset < size:
+            break
+        n -= 1
+    if not n:
+        last_turn, system_at = base_turn, 0
+    missing = []
+    data = _map(segment)
+    if data is None:
+        return n, missing, last_turn
+    with data:
+        if n:
+            start = data.find(b"\n", offset) + 1
+            if start == 0:
+                return n, missing, last_turn
+        pos = start
+        while pos < size:
+            end = data.find(b"\n", pos)
+            if end < 0:
+                break
+            line = data[pos:end]
+            if line.startswith(b'{"$system"'):
+                # a reference always comes right before the first message of a turn
+                system_at = pos
+                missing.append((pos, last_turn + 1, _SYSTEM_FLAG, system_at))
+            else:
+                try:
+                    if json.loads(line).get("role") == "user":
+                        last_turn += 1
+                except ValueError:
+                    pass
+                missing.append((pos, last_turn, 0, system_at))
+            pos = end + 1
+    return n, missing, last_turn
+
+
+def sync_index(segment: Path, base_turn: int = 0) -> int:
+    '''
+    Make the segment's index cover every complete line of the segment, indexing only
+    what is missing (a log from before the index existed, or a crash between the data
+    and the index write). Only the writer calls this. Returns the last turn number.
+    '''
+    idx_path = _index_path(segment)
+    idx = _map(idx_path)
+    try:
+        n, missing, last_turn = _scan(segment, idx, base_turn)
+        size = len(idx) if idx is not None else 0
+    finally:
+        if idx is not None:
+            idx.close()
+    if size == n * _REC.size and not missing:
+        return last_turn
+    with idx_path.open("a+b") as f:
+        f.truncate(n * _REC.size)
+        f.write(b"".join(_REC.pack(*r) for r in missing))
+    return last_turn
+
+
+class HistoryLog:
+    '''
+    Writer for chat_logs/<stem>-NNNNNN.jsonl segments.
+
+    fsync="always" syncs every batch to disk, "interval" at most every
+    fsync_interval_s seconds, "never" leaves it to the OS. flush_every is how many
+    turns are buffered before they are written out.
+    '''
+    def __init__(
+        self,
+        path: str = "chat_logs/log.jsonl",
+        max_bytes: int = 64 * 1024 * 1024,
+        fsync: str = "interval",
+        fsync_interval_s: float = 5.0,
+        flush_every: int = 1,
+    ) -> None:
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"fsync must be one of {FSYNC_POLICIES}, got {fsync!r}")
+        p = Path(path)
+        self.dir = p.parent
+        self.stem = p.stem
+        self.suffix = p.suffix or ".jsonl"
+        self.max_bytes = max_bytes
+        self.fsync = fsync
+        self.fsync_interval_s = fsync_interval_s
+        self.flush_every = max(1, flush_every)
+        self.dir.mkdir(parents=True, exist_ok=True)
+
+        segments = self.segments()
+        self._seg_no = self._number(segments[-1]) if segments else 1
+        self._turn = 0
+        for seg in segments:
+            self._turn = sync_index(seg, self._turn)
+        self._f = self._segment_path(self._seg_no).open("ab")
+        self._idx = _index_path(self._segment_path(self._seg_no)).open("ab")
+        # system ref in force for the messages of the current segment (None = nothing written yet)
+        self._written_ref: str | None = None
+        self._written_at = 0
+        self._pending: list[tuple[str | None, int, bytes]] = []
+        self._pending_turns = 0
+        self._system_obj: dict | None = None
+        self._system_ref: str | None = None
+        self._last_fsync = time.monotonic()
+        self.bytes_written = 0
+        self.flushes = 0
+        self.fsyncs = 0
+
+    def _segment_path(self, n: int) -> Path:
+        return self.dir / f"{self.stem}-{n:06d}{self.suffix}"
+
+    def _number(self, path: Path) -> int:
+        return int(path.stem.rsplit("-", 1)[1])
+
+    def segments(self) -> list[Path]:
+        '''
+        Existing segment files, oldest first
+        '''
+        out = []
+        for path in self.dir.glob(f"{self.stem}-*{self.suffix}"):
+            tail = path.stem.rsplit("-", 1)[-1]
+            if tail.isdigit():
+                out.append(path)
+        return sorted(out, key=self._number)
+
+    def system_path(self, ref: str) -> Path:
+        return self.dir / f"{self.stem}-system-{ref}.json"
+
+    def _ref(self, system_msg: dict) -> str:
+        # the same dict object comes back every turn while the manifest is cached, skip re-hashing it
+        if system_msg is self._system_obj:
+            return self._system_ref
+        blob = json.dumps(system_msg, ensure_ascii=False, sort_keys=True).encode("utf-8")
+        ref = hashlib.sha256(blob).hexdigest()[:16]
+        path = self.system_path(ref)
+        if not path.exists():
+            tmp = path.with_suffix(".tmp")
+            tmp.write_bytes(blob)
+            os.replace(tmp, path)
+        self._system_obj, self._system_ref = system_msg, ref
+        return ref
+
+    def append(self, turn_msgs: list[dict], system: dict | None = None) -> None:
+        '''
+        Queue the new messages of one turn; `system` is the system message they were
+        produced under (stored by reference)
+        '''
+        ref = self._ref(system) if system is not None else self._system_ref
+        self._turn += 1
+        for m in turn_msgs:
+            self._pending.append((ref, self._turn, json.dumps(m, ensure_ascii=False).encode("utf-8") + b"\n"))
+        self._pending_turns += 1
+        if self._pending_turns >= self.flush_every:
+            self.flush()
+
+    def _rotate(self) -> None:
+        self._f.close()
+        self._idx.close()
+        self._seg_no += 1
+        self._f = self._segment_path(self._seg_no).open("ab")
+        self._idx = _index_path(self._segment_path(self._seg_no)).open("ab")
+        # every segment starts with its own system reference so it can be read alone
+        self._written_ref = None
+
+    def flush(self) -> None:
+        if not self._pending:
+            return
+        out, index = [], []
+        size = self._f.tell()
+        batch = sum(len(line) for _, _, line in self._pending)
+        if size > 0 and size + batch > self.max_bytes:
+            self._rotate()
+            size = 0
+        pos = size
+        for ref, turn, line in self._pending:
+            if ref is not None and ref != self._written_ref:
+                marker = json.dumps({"$system": ref}).encode("utf-8") + b"\n"
+                out.append(marker)
+                index.append(_REC.pack(pos, turn, _SYSTEM_FLAG, pos))
+                self._written_at = pos
+                pos += len(marker)
+                self._written_ref = ref
+            out.append(line)
+            index.append(_REC.pack(pos, turn, 0, self._written_at))
+            pos += len(line)
+        data = b"".join(out)
+        # data first: an index record never points at bytes that are not there
+        self._f.write(data)
+        self._f.flush()
+        self._idx.write(b"".join(index))
+        self._idx.flush()
+        self._pending.clear()
+        self._pending_turns = 0
+        self.bytes_written += len(data)
+        self.flushes += 1
+
+        now = time.monotonic()
+        if self.fsync == "always" or (self.fsync == "interval" and now - self._last_fsync >= self.fsync_interval_s):
+            os.fsync(self._f.fileno())
+            self._last_fsync = now
+            self.fsyncs += 1
+
+    def close(self) -> None:
+        self.flush()
+        if self.fsync != "never" and not self._f.closed:
+            os.fsync(self._f.fileno())
+            os.fsync(self._idx.fileno())
+        self._f.close()
+        self._idx.close()
+
+
+class _Index:
+    '''
+    Memory-mapped view of one .idx file, records are unpacked on access. Lines the
+    file does not cover yet (old log, writer crashed or is mid-write) are indexed in
+    memory; the file itself is never modified.
+    '''
+    def __init__(self, segment: Path, base_turn: int = 0) -> None:
+        self._map = _map(_index_path(segment))
+        self._n, self._extra, self.last_turn = _scan(segment, self._map, base_turn)
+
+    def __len__(self) -> int:
+        return self._n + len(self._extra)
+
+    def __getitem__(self, i: int) -> tuple[int, int, int, int]:
+        if 0 <= i < self._n:
+            return _REC.unpack_from(self._map, i * _REC.size)
+        if self._n <= i < len(self):
+            return self._extra[i - self._n]
+        raise IndexError(i)
+
+
+class HistoryReader:
+    '''
+    Random access over a HistoryLog through the offset indexes. Only the index
+    records and lines that are needed get touched. Read-only: it is safe to use while
+    a HistoryLog is writing, and sees the log as it was when the reader was created.
+    '''
+    def __init__(self, path: str = "chat_logs/log.jsonl") -> None:
+        p = Path(path)
+        self.dir, self.stem, self.suffix = p.parent, p.stem, p.suffix or ".jsonl"
+        # same naming as the writer
+        self._segments = HistoryLog.segments(self) if self.dir.exists() else []
+        self._indexes: list[_Index] = []
+        turn = 0
+        for seg in self._segments:
+            self._indexes.append(_Index(seg, turn))
+            turn = self._indexes[-1].last_turn
+
+    _number = HistoryLog._number
+    system_path = HistoryLog.system_path
+
+    def _system(self, data: mmap.mmap, records: _Index, i: int) -> dict | None:
+        # system message in force at record i
+        if i >= len(records):
+            return None
+        at = records[i][3]
+        line = data[at:data.find(b"\n", at)]
+        if not line.startswith(b'{"$system"'):
+            return None
+        path = self.system_path(json.loads(line)["$system"])
+        return json.loads(path.read_bytes()) if path.exists() else None
+
+    def _read(self, picked: list[tuple[Path, _Index, int]], limit: int | None = None) -> list[dict]:
+        # system message in force at the first picked record, then the messages
+        out: list[dict] = []
+        system = None
+        for seg, records, lo in picked:
+            data = _map(seg)
+            if data is None:
+                continue
+            with data:
+                if not out and system is None:
+                    system = self._system(data, records, lo)
+                for i in range(lo, len(records)):
+                    if limit is not None and len(out) >= limit:
+                        break
+                    offset, _, flags, _ = records[i]
+                    if not flags & _SYSTEM_FLAG:
+                        out.append(json.loads(data[offset:data.find(b"\n", offset)]))
+        return ([system] if system is not None else []) + out
+
+    def last_turn(self) -> int:
+        return self._indexes[-1].last_turn if self._indexes else 0
+
+    def tail(self, n: int) -> list[dict]:
+        '''
+        System message plus at least the last n messages, starting at a turn boundary so
+        no tool reply gets separated from the assistant message that called it
+        '''
+        picked = []
+        count = 0
+        for seg, records in zip(reversed(self._segments), reversed(self._indexes)):
+            if not len(records):
+                continue
+            i = len(records)
+            while i > 0 and count < n:
+                i -= 1
+                if not records[i][2] & _SYSTEM_FLAG:
+                    count += 1
+            # widen to the start of that turn, turns never straddle segments
+            if i < len(records):
+                turn = records[i][1]
+                while i > 0 and records[i - 1][1] == turn and not records[i - 1][2] & _SYSTEM_FLAG:
+                    i -= 1
+            picked.append((seg, records, i))
+            if count >= n:
+                break
+        return self._read(picked[::-1])
+
+    def from_turn(self, turn: int, limit: int | None = None) -> list[dict]:
+        '''
+        System message plus the messages from turn number `turn` on (at most `limit`)
+        '''
+        picked = []
+        for seg, records in zip(self._segments, self._indexes):
+            if not len(records) or records[len(records) - 1][1] < turn:
+                continue
+            # turn numbers only grow, so the first segment is a binary search
+            lo = 0 if picked else bisect_left(records, turn, key=lambda r: r[1])
+            picked.append((seg, records, lo))
+            if limit is not None and sum(len(r) - i for _, r, i in picked) >= limit:
+                break
+        return self._read(picked, limit)
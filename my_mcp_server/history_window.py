@@ -0,0 +1,127 @@
+'''
+Token-budgeted conversation window for the client.
+
+The history the model sees is a deque of message groups with their token counts
+computed once, when they are added. Old groups are dropped from the left until the
+window fits the budget, so the prompt stays bounded however long the chat runs and
+however big a single tool reply is. An assistant message with tool_calls and its tool
+replies form one group (the API rejects a tool reply whose call is missing), and the
+system message is pinned outside the deque.
+'''
+from collections import deque
+from typing import Any, Iterable
+import json
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+
+# per-message framing the chat format adds on top of the content
+_MESSAGE_OVERHEAD = 4
+
+
+def _encoder():
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.get_encoding("o200k_base")
+    except Exception:
+        return None
+
+
+_ENC = _encoder()
+
+
+def count_tokens(msg: dict) -> int:
+    '''
+    Tokens of one chat message: exact with tiktoken (pip install .[tokens]),
+    otherwise the usual ~4 characters per token estimate
+    '''
+    parts = []
+    content = msg.get("content")
+    if isinstance(content, str):
+        parts.append(content)
+    elif content:
+        parts.append(json.dumps(content, ensure_ascii=False))
+    if msg.get("tool_calls"):
+        parts.append(json.dumps(msg["tool_calls"], ensure_ascii=False))
+    text = "".join(parts)
+    n = len(_ENC.encode(text)) if _ENC is not None else (len(text) + 3) // 4
+    return n + _MESSAGE_OVERHEAD
+
+
+class HistoryWindow:
+    '''
+    System message + the most recent messages that fit in budget_tokens
+    '''
+    def __init__(self, budget_tokens: int, messages: Iterable[dict] = ()) -> None:
+        self.budget_tokens = budget_tokens
+        self._groups: deque[tuple[list[dict], int]] = deque()
+        self.tokens = 0
+        self.system: dict | None = None
+        self.system_tokens = 0
+        self.evicted = 0
+        msgs = list(messages)
+        if msgs and msgs[0].get("role") == "system":
+            self.set_system(msgs.pop(0))
+        self.extend(msgs)
+
+    def set_system(self, msg: dict) -> None:
+        # the cached manifest hands back the same object every turn, only count a new one
+        if msg is self.system:
+            return
+        self.system = msg
+        self.system_tokens = count_tokens(msg)
+        self._evict()
+
+    def extend(self, msgs: Iterable[dict]) -> None:
+        '''
+        Add the messages of a turn, then evict from the oldest end to fit the budget
+        '''
+        for m in msgs:
+            if m.get("role") == "tool" and self._groups and self._groups[-1][0][0].get("tool_calls"):
+                # reply to the call that opened the last group
+                group, tokens = self._groups.pop()
+                n = count_tokens(m)
+                group.append(m)
+                self._groups.append((group, tokens + n))
+            else:
+                n = count_tokens(m)
+                self._groups.append(([m], n))
+            self.tokens += n
+        self._evict()
+
+    def _evict(self) -> None:
+        budget = self.budget_tokens - self.system_tokens
+        while self._groups and self.tokens > budget:
+            group, tokens = self._groups.popleft()
+            self.tokens -= tokens
+            self.evicted += len(group)
+        # a window starting with a bare tool reply (no call before it) is rejected by the API
+        while self._groups and self._groups[0][0][0].get("role") == "tool":
+            group, tokens = self._groups.popleft()
+            self.tokens -= tokens
+            self.evicted += len(group)
+
+    def messages(self) -> list[dict]:
+        '''
+        The prompt history: system message first, then the kept messages in order
+        '''
+        out = [self.system] if self.system is not None else []
+        for group, _ in self._groups:
+            out.extend(group)
+        return out
+
+    def __len__(self) -> int:
+        return sum(len(group) for group, _ in self._groups)
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "messages": len(self),
+            "tokens": self.tokens + self.system_tokens,
+            "budget_tokens": self.budget_tokens,
+            "evicted": self.evicted,
+            "exact": _ENC is not None,
+        }
@@ -0,0 +1,124 @@
+'''
+Batch SGP4 propagation for cloud_server.
+
+TLEs are parsed into sgp4 Satrec objects once and kept in an LRU keyed by
+satelliteId (re-parsed only when the lines change). A propagation call stacks the
+satellites into one SatrecArray and evaluates every satellite at every time of the
+grid in a single vectorized call; the TEME -> Earth-fixed rotation and the geodetic
+conversion are NumPy over the whole (satellites x times) block.
+'''
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Any
+import math
+import numpy as np
+
+try:
+    from sgp4.api import Satrec, SatrecArray
+except ImportError:
+    Satrec = SatrecArray = None
+
+
+# WGS84
+_A_KM = 6378.137
+_F = 1 / 298.257223563
+_E2 = _F * (2 - _F)
+UNIX_EPOCH_JD = 2440587.5
+
+
+def can_propagate() -> bool:
+    # needs the optional sgp4 package (pip install .[orbit])
+    return Satrec is not None
+
+
+class SatrecCache:
+    '''
+    satelliteId -> parsed Satrec, LRU bounded
+    '''
+    def __init__(self, max_entries: int = 20000) -> None:
+        self.max_entries = max_entries
+        self._lru: OrderedDict[Any, tuple[str, str, Any]] = OrderedDict()
+        self.hits = 0
+        self.parses = 0
+        self.errors = 0
+
+    def get(self, sat_id, line1: str, line2: str):
+        '''
+        Parsed Satrec for the record, or None if the lines do not parse
+        '''
+        entry = self._lru.get(sat_id)
+        if entry is not None and entry[0] == line1 and entry[1] == line2:
+            self._lru.move_to_end(sat_id)
+            self.hits += 1
+            return entry[2]
+        try:
+            sat = Satrec.twoline2rv(line1, line2)
+        except Exception:
+            self.errors += 1
+            return None
+        self.parses += 1
+        self._lru[sat_id] = (line1, line2, sat)
+        self._lru.move_to_end(sat_id)
+        while len(self._lru) > self.max_entries:
+            self._lru.popitem(last=False)
+        return sat
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "entries": len(self._lru),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "parses": self.parses,
+            "parse_errors": self.errors,
+        }
+
+
+def time_grid(start: datetime, step_s: float, steps: int) -> tuple[np.ndarray, np.ndarray]:
+    '''
+    (jd, fr) arrays for `steps` instants every `step_s` seconds from start (UTC),
+    split in whole and fractional days the way sgp4 wants them
+    '''
+    if start.tzinfo is None:
+        start = start.replace(tzinfo=timezone.utc)
+    days = start.timestamp() / 86400.0 + np.arange(steps) * (step_s / 86400.0)
+    whole = np.floor(days)
+    return UNIX_EPOCH_JD + whole, days - whole
+
+
+def _gmst(jd: np.ndarray, fr: np.ndarray) -> np.ndarray:
+    # IAU-82 sidereal time, same model as sgp4's gstime (TEME is defined against it)
+    t = ((jd - 2451545.0) + fr) / 36525.0
+    sec = -6.2e-6 * t**3 + 0.093104 * t**2 + (876600.0 * 3600 + 8640184.812866) * t + 67310.54841
+    return np.mod(np.radians(sec / 240.0), 2 * math.pi)
+
+
+def teme_to_geodetic(r: np.ndarray, jd: np.ndarray, fr: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    '''
+    TEME positions (n_sats, n_times, 3) in km -> WGS84 latitude, longitude (degrees)
+    and altitude (km), each (n_sats, n_times). Polar motion is ignored (metres).
+    '''
+    g = _gmst(jd, fr)
+    cg, sg = np.cos(g), np.sin(g)
+    x = cg * r[..., 0] + sg * r[..., 1]
+    y = -sg * r[..., 0] + cg * r[..., 1]
+    z = r[..., 2]
+
+    lon = np.degrees(np.arctan2(y, x))
+    p = np.hypot(x, y)
+    lat = np.arctan2(z, p * (1 - _E2))
+    # two fixed-point steps already converge well below a metre for anything in orbit
+    for _ in range(2):
+        sl = np.sin(lat)
+        n = _A_KM / np.sqrt(1 - _E2 * sl * sl)
+        lat = np.arctan2(z + _E2 * n * sl, p)
+    sl = np.sin(lat)
+    alt = p * np.cos(lat) + z * sl - _A_KM * np.sqrt(1 - _E2 * sl**2)
+    return np.degrees(lat), lon, alt
+
+
+def propagate(sats: list, jd: np.ndarray, fr: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    '''
+    Every satellite at every time in one SatrecArray call: (errors, positions, velocities)
+    shaped (n_sats, n_times), (n_sats, n_times, 3), (n_sats, n_times, 3). TEME frame, km and km/s.
+    '''
+    return SatrecArray(sats).sgp4(jd, fr)
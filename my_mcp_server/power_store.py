@@ -0,0 +1,124 @@
+'''
+Local time-series store for NASA POWER daily values.
+
+Values are kept per location and per day in SQLite, keyed on the exact coordinates
+the caller asked for: POWER interpolates / picks its source grid cell itself (and its
+grids differ per parameter source), so snapping to a grid of our own would change
+the answer. A call asks the store which days of its window are already held and only
+the missing sub-ranges go to the POWER API, so repeated or sliding windows over the
+same region cost almost no network I/O. Only final days are stored: POWER keeps
+revising the most recent ones and flags days it has no data for with -999.
+'''
+from datetime import date, timedelta
+import os
+import sqlite3
+
+
+POWER_FILL = -999.0
+
+
+def _day_key(d: date) -> str:
+    # POWER keys its daily values as YYYYMMDD
+    return d.strftime("%Y%m%d")
+
+
+class PowerStore:
+    '''
+    SQLite-backed (param, day) -> value series per location
+    '''
+    def __init__(self, db_path: str = ":memory:") -> None:
+        if db_path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS power_values ("
+            " lat REAL NOT NULL, lon REAL NOT NULL, param TEXT NOT NULL, day TEXT NOT NULL, value REAL NOT NULL,"
+            " PRIMARY KEY (lat, lon, param, day)) WITHOUT ROWID"
+        )
+        self._db.commit()
+        self.days_served = 0
+        self.days_written = 0
+
+    def close(self) -> None:
+        self._db.close()
+
+    def location(self, lat: float, lon: float) -> tuple[float, float]:
+        '''
+        Store key for (lat, lon): the coordinates themselves, the same point POWER is asked for
+        '''
+        return float(lat), float(lon)
+
+    def missing(
+        self, loc: tuple[float, float], params: list[str], start: date, end: date, merge_gap_days: int = 31
+    ) -> list[tuple[date, date]]:
+        '''
+        Contiguous (start, end) sub-ranges of the window not yet held for every param.
+        Ranges separated by fewer than merge_gap_days held days are fetched as one, a
+        round-trip costs more than re-downloading a few days.
+        '''
+        rows = self._db.execute(
+            f"SELECT day FROM power_values WHERE lat = ? AND lon = ? AND param IN ({','.join('?' * len(params))})"
+            " AND day BETWEEN ? AND ? GROUP BY day HAVING COUNT(*) = ?",
+            (*loc, *params, _day_key(start), _day_key(end), len(params)),
+        ).fetchall()
+        held = {r[0] for r in rows}
+
+        ranges, run_start, d = [], None, start
+        while d <= end:
+            if _day_key(d) in held:
+                if run_start is not None:
+                    ranges.append((run_start, d - timedelta(days=1)))
+                    run_start = None
+            elif run_start is None:
+                run_start = d
+            d += timedelta(days=1)
+        if run_start is not None:
+            ranges.append((run_start, end))
+
+        merged = []
+        for lo, hi in ranges:
+            if merged and (lo - merged[-1][1]).days <= merge_gap_days:
+                merged[-1] = (merged[-1][0], hi)
+            else:
+                merged.append((lo, hi))
+        self.days_served += len(held)
+        return merged
+
+    def put(self, loc: tuple[float, float], parameter: dict, final_before: date) -> None:
+        '''
+        Store the final, non-fill days of a POWER "parameter" block
+        '''
+        cutoff = _day_key(final_before)
+        rows = []
+        for param, series in parameter.items():
+            if not isinstance(series, dict):
+                continue
+            for day, value in series.items():
+                if day < cutoff and isinstance(value, (int, float)) and value != POWER_FILL:
+                    rows.append((*loc, param, day, float(value)))
+        self._db.executemany("INSERT OR REPLACE INTO power_values VALUES (?, ?, ?, ?, ?)", rows)
+        self._db.commit()
+        self.days_written += len({r[3] for r in rows})
+
+    def get(self, loc: tuple[float, float], params: list[str], start: date, end: date) -> dict[str, dict[str, float]]:
+        out = {p: {} for p in params}
+        rows = self._db.execute(
+            f"SELECT param, day, value FROM power_values WHERE lat = ? AND lon = ? AND param IN ({','.join('?' * len(params))})"
+            " AND day BETWEEN ? AND ?",
+            (*loc, *params, _day_key(start), _day_key(end)),
+        )
+        for param, day, value in rows:
+            out[param][day] = value
+        return out
+
+    def stats(self) -> dict:
+        locations, values = self._db.execute(
+            "SELECT COUNT(DISTINCT lat || ',' || lon), COUNT(*) FROM power_values"
+        ).fetchone()
+        return {
+            "locations": locations,
+            "values": values,
+            "days_served_locally": self.days_served,
+            "days_written": self.days_written,
+        }
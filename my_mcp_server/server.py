@@ -1,12 +1,22 @@
 # Reference: https://modelcontextprotocol.io/quickstart/client 
-import httpx
-from typing import Any, Optional
 from mcp.server.fastmcp import FastMCP
-import json
+from contextlib import asynccontextmanager, suppress
+from datetime import date, datetime, timedelta
+from functools import partial
 import sys
+import os
+import asyncio
+import json
 import logging
 import math
+import numpy as np
+from typing import Literal
 from pydantic import BaseModel
+import geo
+import hazard_index
+import power_store
+import upstream
+from upstream import make_request
 
 
 
@@ -15,7 +25,52 @@ EONET_API = "https://eonet.gsfc.nasa.gov/api/v3/events"
 DONKI_API = "https://api.nasa.gov/DONKI/alerts"
 SOLAR_API = "https://power.larc.nasa.gov/api/temporal/daily/point"
 NASA_KEY = "DEMO"
-mcp = FastMCP(name="MyMCPServer")
+# POWER keeps revising the most recent days, anything older than this is final
+POWER_FINAL_AFTER_DAYS = 7
+# in-memory EONET index: how many days back it holds (0 disables it) and how often it refreshes
+HAZARD_INDEX_DAYS = int(os.getenv("HAZARD_INDEX_DAYS", "90"))
+HAZARD_INDEX_REFRESH_S = float(os.getenv("HAZARD_INDEX_REFRESH_S", "900"))
+HAZARD_INDEX_CELL_DEG = float(os.getenv("HAZARD_INDEX_CELL_DEG", "1.0"))
+# past this age without a successful refresh queries go back to the network
+HAZARD_INDEX_MAX_AGE_S = float(os.getenv("HAZARD_INDEX_MAX_AGE_S", str(4 * HAZARD_INDEX_REFRESH_S)))
+# long EONET windows are fetched as parallel chunks of this many days
+EONET_CHUNK_DAYS = int(os.getenv("EONET_CHUNK_DAYS", "30"))
+# local POWER time-series store per location, POWER_STORE=0 always fetches the whole window
+POWER_STORE = os.getenv("POWER_STORE", "1") == "1"
+POWER_STORE_DB = os.getenv("POWER_STORE_DB", ":memory:")
+POWER_PARAMS = ["ALLSKY_SFC_SW_DWN", "PRECTOTCORR"]
+# how many sites rank_solar_sites fetches from POWER at once
+SOLAR_SITE_CONCURRENCY = int(os.getenv("SOLAR_SITE_CONCURRENCY", "8"))
+
+hazard_idx = hazard_index.HazardIndex(cell_deg=HAZARD_INDEX_CELL_DEG, max_age_s=HAZARD_INDEX_MAX_AGE_S)
+power_series = power_store.PowerStore(POWER_STORE_DB) if POWER_STORE else None
+_index_task: asyncio.Task | None = None
+
+
+@asynccontextmanager
+async def lifespan(server):
+    '''
+    Shared HTTP client plus the background task keeping the hazard index fresh
+    '''
+    global _index_task
+    async with upstream.lifespan(server):
+        owner = False
+        if HAZARD_INDEX_DAYS > 0 and _index_task is None:
+            # the index stamps every refresh as current, so it must not re-read a cached feed
+            _index_task = asyncio.create_task(hazard_index.keep_fresh(
+                hazard_idx, partial(_fetch_eonet, fresh=True), HAZARD_INDEX_DAYS, HAZARD_INDEX_REFRESH_S
+            ))
+            owner = True
+        try:
+            yield
+        finally:
+            if owner:
+                _index_task.cancel()
+                with suppress(asyncio.CancelledError):
+                    await _index_task
+                _index_task = None
+
+mcp = FastMCP(name="MyMCPServer", lifespan=lifespan)
 
 # configure logging
 logging.basicConfig(
@@ -24,14 +79,23 @@ logging.basicConfig(
     stream=sys.stderr,
 )
 
-# for some reason it only works with this
-DEFAULT_HEADERS = {
-    "Accept": "application/json",
-    "User-Agent": "Mozilla/5.0 (compatible; mcp-client/1.0; +https://example.com)",
-    "Connection": "close",
-}
 
 
+def _power_ttl(params: dict) -> float:
+    # historical POWER data never changes, recent days get re-fetched hourly
+    try:
+        end = datetime.strptime(str(params.get("end", "")), "%Y%m%d").date()
+    except ValueError:
+        return 3600
+    if end < date.today() - timedelta(days=POWER_FINAL_AFTER_DAYS):
+        return math.inf
+    return 3600
+
+# DONKI alerts are short-lived, EONET events keep getting new geometry
+upstream.cache.set_ttl(DONKI_API, 300)
+upstream.cache.set_ttl(EONET_API, 900)
+upstream.cache.set_ttl(SOLAR_API, _power_ttl)
+
 
 class Hazards(BaseModel):
     lat: float
@@ -40,20 +104,43 @@ class Hazards(BaseModel):
     start_date: str
     end_date: str
     categories: list[str] | None = None
+    # parse the upstream response incrementally instead of loading it whole (needs ijson)
+    stream: bool = False
+    # "columnar" returns {field: [values]} instead of a list of objects
+    format: Literal["rows", "columnar"] = "rows"
+    precision: int | None = None
+
+class Site(BaseModel):
+    id: str | None = None
+    lat: float
+    lon: float
+    radius_km: float = 250
+
+class HazardsBatch(BaseModel):
+    sites: list[Site]
+    start_date: str
+    end_date: str
+    categories: list[str] | None = None
 
 class SolarWindow(BaseModel):
     lat: float
     lon: float
     start_date: str
     end_date: str
+    stream: bool = False
+    format: Literal["rows", "columnar"] = "rows"
+    precision: int | None = None
 
-def _haversine_km(a: tuple, b: tuple) -> float:
-    # a=(lat,lon), b=(lat,lon)
-    R=6371.0
-    dlat=math.radians(b[0]-a[0])
-    dlon=math.radians(b[1]-a[1])
-    s = (math.sin(dlat/2)**2 + math.cos(math.radians(a[0]))*math.cos(math.radians(b[0]))*math.sin(dlon/2)**2)
-    return 2*R*math.asin(math.sqrt(s))
+class SolarSite(BaseModel):
+    id: str | None = None
+    lat: float
+    lon: float
+
+class SolarSites(BaseModel):
+    sites: list[SolarSite]
+    start_date: str
+    end_date: str
+    top_k: int = 10
 
 # TODO implemented due to certain None errors, not sure if they're necessary
 def _safe_list(val):
@@ -67,181 +154,566 @@ def _safe_val(obj, key, default=None):
         return default if val is None else val
     return default
 
-@mcp.tool()
-async def list_hazards(input: Hazards) -> dict:
-    """List natural hazards near a location (EONET + DONKI)."""
-    logging.info("Using tool list_hazards")
-    events = []
+def _shape(rows: list[dict], fmt: str = "rows", precision: int | None = None):
+    '''
+    Output shaping for tool payloads: round floats to `precision` decimals and, for
+    fmt="columnar", turn the list of dicts into {field: [values...]} parallel arrays
+    so the keys are sent once instead of once per row
+    '''
+    if precision is not None:
+        rows = [{k: (round(v, precision) if isinstance(v, float) else v) for k, v in r.items()} for r in rows]
+    if fmt != "columnar":
+        return rows
+    fields = {}
+    for r in rows:
+        for k in r:
+            fields.setdefault(k, None)
+    return {k: [r.get(k) for r in rows] for k in fields}
+
+def _want_stream(requested: bool) -> bool:
+    if requested and not upstream.can_stream():
+        logging.warning("Streaming requested but ijson is not installed, parsing the full response")
+        return False
+    return requested
+
+async def _fetch_all(*requests) -> list:
+    '''
+    Run independent upstream fetches concurrently. A source that raises yields None
+    so the others still come back; cancelling the tool call cancels every fetch.
+    '''
+    results = await asyncio.gather(*requests, return_exceptions=True)
+    out = []
+    for res in results:
+        if isinstance(res, asyncio.CancelledError):
+            raise res
+        if isinstance(res, BaseException):
+            logging.error("Upstream fetch failed: %r", res)
+            res = None
+        out.append(res)
+    return out
+
+def _error_event(source: str, note: str, category: list | None = None) -> dict:
+    return {
+        "source": source,
+        "title": f"{source} error",
+        "category": category or [],
+        "distance_km": None,
+        "when": None,
+        "lat": None, "lon": None,
+        "id": None,
+        "link": None,
+        "note": note
+    }
 
-    # ----- EONET -----
-    eonet = await make_request(
-        EONET_API,
-        params={"status": "all", "start": input.start_date, "end": input.end_date}
-    )
-    eonet_events = _safe_list(_safe_val(eonet, "events", []))
+def _donki_events(donki) -> list[dict]:
+    # in case it yields error
+    if donki is None:
+        return [_error_event("DONKI", "DONKI unavailable", ["Space Weather"])]
+    if isinstance(donki, dict) and "error" in donki:
+        note = _safe_val(_safe_val(donki, "error", {}), "message", "Unknown DONKI error")
+        return [_error_event("DONKI", note, ["Space Weather"])]
 
-    cats_filter = {c.lower() for c in (input.categories or [])} or None
+    events = []
+    for al in _safe_list(donki):
+        events.append({
+            "source": "DONKI",
+            "title": _safe_val(al, "messageType", "Alert"),
+            "category": ["Space Weather"],
+            "distance_km": None,
+            "when": _safe_val(al, "messageIssueTime", None),
+            "lat": None, "lon": None,
+            "id": _safe_val(al, "alertId", None),
+            "link": _safe_val(al, "link", None)
+        })
+    return events
 
+def _flatten_eonet(eonet_events: list, cats_filter: set[str] | None):
+    '''
+    Single pass over the EONET feed: keep the events that pass the category filter
+    and flatten their valid Point geometries into contiguous lat/lon arrays, each
+    point tagged with the index of its event in `kept`
+    '''
+    kept, points, owners, lats, lons = [], [], [], [], []
     for ev in eonet_events:
         ev_categories = _safe_list(_safe_val(ev, "categories", []))
         ev_cat_titles = {(_safe_val(c, "title", "") or "").lower() for c in ev_categories if isinstance(c, dict)}
         if cats_filter and not (ev_cat_titles & cats_filter):
             continue
 
-        nearest, ndist = None, None
+        idx = len(kept)
+        kept.append((ev, ev_categories))
+        # same checks as _safe_val/_safe_list, inlined because this is the hot loop
         for g in _safe_list(_safe_val(ev, "geometry", [])):
-            if _safe_val(g, "type", None) != "Point":
+            if not isinstance(g, dict) or g.get("type") != "Point":
                 continue
-            coords = _safe_list(_safe_val(g, "coordinates", []))
-            if len(coords) < 2:
+            coords = g.get("coordinates")
+            if not isinstance(coords, list) or len(coords) < 2:
                 continue
             lon, lat = coords[0], coords[1]
             if not isinstance(lat, (int, float)) or not isinstance(lon, (int, float)):
                 continue
+            points.append((lat, lon, g.get("date")))
+            owners.append(idx)
+            lats.append(lat)
+            lons.append(lon)
+
+    return (kept, points, np.asarray(lats, dtype=np.float64), np.asarray(lons, dtype=np.float64),
+            np.asarray(owners, dtype=np.int64))
+
+def _eonet_event(ev: dict, ev_categories: list, nearest: tuple, ndist: float) -> dict:
+    href = None
+    links = _safe_list(_safe_val(ev, "links", []))
+    if links and isinstance(links[0], dict):
+        href = _safe_val(links[0], "href", None)
+
+    return {
+        "source": "EONET",
+        "title": _safe_val(ev, "title", None),
+        "category": [_safe_val(c, "title", None) for c in ev_categories if isinstance(c, dict)],
+        "distance_km": round(ndist, 1),
+        "when": nearest[2],
+        "lat": nearest[0],
+        "lon": nearest[1],
+        "id": _safe_val(ev, "id", None),
+        "link": href
+    }
 
-            d = _haversine_km((input.lat, input.lon), (lat, lon))
-            if ndist is None or d < ndist:
-                ndist, nearest = d, (lat, lon, _safe_val(g, "date", None))
-
-        if ndist is not None and ndist <= getattr(input, "radius_km", 250):
-            href = None
-            links = _safe_list(_safe_val(ev, "links", []))
-            if links and isinstance(links[0], dict):
-                href = _safe_val(links[0], "href", None)
-
-            events.append({
-                "source": "EONET",
-                "title": _safe_val(ev, "title", None),
-                "category": [_safe_val(c, "title", None) for c in ev_categories if isinstance(c, dict)],
-                "distance_km": round(ndist, 1),
-                "when": nearest[2] if nearest else None,
-                "lat": nearest[0] if nearest else None,
-                "lon": nearest[1] if nearest else None,
-                "id": _safe_val(ev, "id", None),
-                "link": href
-            })
-
-    donki = await make_request(
-        DONKI_API,
-        params={"startDate": input.start_date, "endDate": input.end_date, "api_key": NASA_KEY}
+def _events_near(flat: tuple, lat: float, lon: float, radius_km: float) -> list[dict]:
+    '''
+    EONET rows for the events of a flattened feed (see _flatten_eonet) whose nearest
+    point lies within radius_km of (lat, lon)
+    '''
+    kept, points, lats, lons, owners = flat
+    # a point farther in latitude than the radius can't be inside it, skip its trig entirely
+    band = np.flatnonzero(np.abs(lats - lat) <= math.degrees(radius_km / geo.EARTH_RADIUS_KM) + 1e-6)
+
+    # all great-circle distances in one batch, then the nearest point per event
+    best, dist = geo.nearest_per_group(
+        lat, lon, lats[band], lons[band], owners[band], len(kept), max_km=radius_km
     )
+    rows = []
+    for i, (ev, ev_categories) in enumerate(kept):
+        if best[i] >= 0:
+            rows.append(_eonet_event(ev, ev_categories, points[band[best[i]]], float(dist[i])))
+    return rows
 
-    # in case it yields error
-    if isinstance(donki, dict) and "error" in donki:
+def _date_chunks(start_date: str, end_date: str, days: int) -> list[tuple[str, str]]:
+    '''
+    Split [start_date, end_date] into inclusive chunks aligned to a fixed `days` grid,
+    newest first, so overlapping windows share (and cache) their interior chunks
+    '''
+    try:
+        start = date.fromisoformat(start_date[:10])
+        end = date.fromisoformat(end_date[:10])
+    except ValueError:
+        return [(start_date, end_date)]
+    if days <= 0 or end < start:
+        return [(start_date, end_date)]
+
+    chunks = []
+    lo = start
+    while lo <= end:
+        grid_end = date.fromordinal((lo.toordinal() // days + 1) * days - 1)
+        hi = min(grid_end, end)
+        chunks.append((lo.isoformat(), hi.isoformat()))
+        lo = hi + timedelta(days=1)
+    return chunks[::-1]
+
+def _eonet_bbox(lat: float, lon: float, radius_km: float) -> list[str]:
+    # EONET wants min_lon,max_lat,max_lon,min_lat; round outwards so nearby queries share keys
+    boxes = geo.bounding_boxes(lat, lon, radius_km)
+    if boxes == [(-180.0, -90.0, 180.0, 90.0)]:
+        return []
+    out = []
+    for min_lon, min_lat, max_lon, max_lat in boxes:
+        out.append(",".join(f"{v:g}" for v in (
+            max(math.floor(min_lon * 100) / 100, -180.0),
+            min(math.ceil(max_lat * 100) / 100, 90.0),
+            min(math.ceil(max_lon * 100) / 100, 180.0),
+            max(math.floor(min_lat * 100) / 100, -90.0),
+        )))
+    return out
+
+def _eonet_params(start_date: str, end_date: str, bboxes: list[str] | None = None) -> list[dict]:
+    out = []
+    for start, end in _date_chunks(start_date, end_date, EONET_CHUNK_DAYS):
+        for bbox in (bboxes or [None]):
+            params = {"status": "all", "start": start, "end": end}
+            if bbox:
+                params["bbox"] = bbox
+            out.append(params)
+    return out
+
+async def _fetch_eonet(start_date: str, end_date: str, bboxes: list[str] | None = None, fresh: bool = False) -> list | None:
+    '''
+    EONET events between the dates, fetched as date chunks (times bounding boxes, if
+    any) in parallel and merged by event id. None if any piece failed, partial feeds
+    would silently drop hazards. fresh=True skips the response cache.
+    '''
+    requests = [make_request(EONET_API, params=p, fresh=fresh) for p in _eonet_params(start_date, end_date, bboxes)]
 
-        events.append({
-            "source": "DONKI",
-            "title": "DONKI error",
-            "category": ["Space Weather"],
-            "distance_km": None,
-            "when": None,
-            "lat": None, "lon": None,
-            "id": None,
-            "link": None,
-            "note": _safe_val(_safe_val(donki, "error", {}), "message", "Unknown DONKI error")
-        })
+    merged, seen = [], set()
+    for eonet in await _fetch_all(*requests):
+        if eonet is None:
+            return None
+        for ev in _safe_list(_safe_val(eonet, "events", [])):
+            ev_id = _safe_val(ev, "id", None)
+            if ev_id is not None:
+                if ev_id in seen:
+                    continue
+                seen.add(ev_id)
+            merged.append(ev)
+    return merged
+
+def _event_near(ev, cats_filter: set[str] | None, lat: float, lon: float, radius_km: float) -> dict | None:
+    '''
+    Scalar _flatten_eonet + _events_near for a single event, used while streaming
+    where events arrive one at a time
+    '''
+    ev_categories = _safe_list(_safe_val(ev, "categories", []))
+    ev_cat_titles = {(_safe_val(c, "title", "") or "").lower() for c in ev_categories if isinstance(c, dict)}
+    if cats_filter and not (ev_cat_titles & cats_filter):
+        return None
+
+    nearest, ndist = None, None
+    for g in _safe_list(_safe_val(ev, "geometry", [])):
+        if not isinstance(g, dict) or g.get("type") != "Point":
+            continue
+        coords = g.get("coordinates")
+        if not isinstance(coords, list) or len(coords) < 2:
+            continue
+        p_lon, p_lat = coords[0], coords[1]
+        if not isinstance(p_lat, (int, float)) or not isinstance(p_lon, (int, float)):
+            continue
+        d = geo.haversine_km((lat, lon), (p_lat, p_lon))
+        if ndist is None or d < ndist:
+            ndist, nearest = d, (p_lat, p_lon, g.get("date"))
+
+    if ndist is not None and ndist <= radius_km:
+        return _eonet_event(ev, ev_categories, nearest, ndist)
+    return None
+
+async def _stream_eonet_near(input: Hazards, cats_filter: set[str] | None) -> list[dict]:
+    '''
+    Streaming EONET path: every chunk/bbox response is parsed event by event and
+    filtered on the fly, so memory holds one event per stream plus the matching rows
+    '''
+    bboxes = _eonet_bbox(input.lat, input.lon, input.radius_km)
+
+    async def consume(params: dict) -> list[dict]:
+        rows = []
+        async for ev in upstream.stream_items(EONET_API, "events.item", params):
+            row = _event_near(ev, cats_filter, input.lat, input.lon, input.radius_km)
+            if row is not None:
+                rows.append(row)
+        return rows
+
+    # a TaskGroup cancels the other streams as soon as one fails
+    async with asyncio.TaskGroup() as tg:
+        tasks = [tg.create_task(consume(p)) for p in _eonet_params(input.start_date, input.end_date, bboxes)]
+
+    # same merge order and id dedup as _fetch_eonet
+    out, seen = [], set()
+    for task in tasks:
+        for row in task.result():
+            if row["id"] is not None:
+                if row["id"] in seen:
+                    continue
+                seen.add(row["id"])
+            out.append(row)
+    return out
+
+async def _eonet_near(input: Hazards) -> list | None:
+    # the index only prunes candidates, the exact distance filter below is the same either way
+    if hazard_idx.covers(input.start_date, input.end_date):
+        return hazard_idx.query(input.lat, input.lon, input.radius_km, input.start_date, input.end_date)
+    return await _fetch_eonet(
+        input.start_date, input.end_date, _eonet_bbox(input.lat, input.lon, input.radius_km)
+    )
+
+@mcp.tool()
+async def list_hazards(input: Hazards) -> dict:
+    """List natural hazards near a location (EONET + DONKI)."""
+    logging.info("Using tool list_hazards")
+    events = []
+
+    cats_filter = {c.lower() for c in (input.categories or [])} or None
+    # the index is already in memory, streaming only matters on the network path
+    streaming = _want_stream(input.stream) and not hazard_idx.covers(input.start_date, input.end_date)
+
+    eonet, donki = await _fetch_all(
+        _stream_eonet_near(input, cats_filter) if streaming else _eonet_near(input),
+        make_request(
+            DONKI_API,
+            params={"startDate": input.start_date, "endDate": input.end_date, "api_key": NASA_KEY}
+        ),
+    )
+
+    # ----- EONET -----
+    if eonet is None:
+        events.append(_error_event("EONET", "EONET unavailable"))
+    elif streaming:
+        events.extend(eonet)
     else:
-        for al in _safe_list(donki):
-            events.append({
-                "source": "DONKI",
-                "title": _safe_val(al, "messageType", "Alert"),
-                "category": ["Space Weather"],
-                "distance_km": None,
-                "when": _safe_val(al, "messageIssueTime", None),
-                "lat": None, "lon": None,
-                "id": _safe_val(al, "alertId", None),
-                "link": _safe_val(al, "link", None)
-            })
+        flat = _flatten_eonet(eonet, cats_filter)
+        events.extend(_events_near(flat, input.lat, input.lon, input.radius_km))
 
-    return {"events": events}
+    # ----- DONKI -----
+    events.extend(_donki_events(donki))
 
+    return {"events": _shape(events, input.format, input.precision)}
 
 
 @mcp.tool()
-async def solar_weather(input: SolarWindow):
-    """Rank dates by solar potential and low precip; exclude severe space weather."""
+async def list_hazards_batch(input: HazardsBatch) -> dict:
+    """List natural hazards near many sites at once, sharing one EONET + DONKI fetch."""
+    logging.info("Using tool list_hazards_batch (%d sites)", len(input.sites))
+
+    async def _eonet_window():
+        if hazard_idx.covers(input.start_date, input.end_date):
+            return hazard_idx.window(input.start_date, input.end_date)
+        return await _fetch_eonet(input.start_date, input.end_date)
+
+    eonet_events, donki = await _fetch_all(
+        _eonet_window(),
+        make_request(
+            DONKI_API,
+            params={"startDate": input.start_date, "endDate": input.end_date, "api_key": NASA_KEY}
+        ),
+    )
+    eonet_error = eonet_events is None
+
+    # parse and flatten the feed once, then only the distance math runs per site
+    cats_filter = {c.lower() for c in (input.categories or [])} or None
+    flat = _flatten_eonet(eonet_events or [], cats_filter)
+
+    sites = {}
+    for i, site in enumerate(input.sites):
+        key = site.id or f"{site.lat},{site.lon}"
+        if key in sites:
+            key = f"{key}#{i}"
+        if eonet_error:
+            sites[key] = {"events": [_error_event("EONET", "EONET unavailable")]}
+        else:
+            sites[key] = {"events": _events_near(flat, site.lat, site.lon, site.radius_km)}
+
+    # space weather is global, report it once instead of copying it into every site
+    return {"sites": sites, "space_weather": _donki_events(donki)}
+
 
-    params = {
-        "parameters":"ALLSKY_SFC_SW_DWN,PRECTOTCORR",
+
+async def _stream_power(params: dict) -> dict:
+    '''
+    POWER response rebuilt from streamed records: only the per-day numbers under
+    properties.parameter are kept, never the raw document
+    '''
+    parameter = {}
+    async for prefix, event, value in upstream.stream_parse(SOLAR_API, params):
+        if event == "number" and prefix.startswith("properties.parameter."):
+            name, _, day = prefix[len("properties.parameter."):].partition(".")
+            parameter.setdefault(name, {})[day] = value
+    return {"properties": {"parameter": parameter}}
+
+def _power_params(lat: float, lon: float, start: str, end: str) -> dict:
+    # start/end as YYYYMMDD
+    return {
+        "parameters":",".join(POWER_PARAMS),
         "community":"RE",
-        "longitude":input.lon,
-        "latitude":input.lat,
-        "start":input.start_date.replace("-",""),
-        "end":input.end_date.replace("-",""),
+        "longitude":lon,
+        "latitude":lat,
+        "start":start,
+        "end":end,
         "format":"JSON"
     }
-    power = await make_request(SOLAR_API, params)
-    d = power["properties"]["parameter"]
+
+def _power_block(power) -> dict | None:
+    block = _safe_val(_safe_val(power, "properties", {}), "parameter", None)
+    return block if isinstance(block, dict) else None
+
+async def _power_window(lat: float, lon: float, start_date: str, end_date: str, stream: bool = False) -> dict | None:
+    '''
+    POWER "parameter" block ({name: {YYYYMMDD: value}}) for the window. Days the local
+    store already holds for the location are served from it; only the missing
+    sub-ranges are fetched, in parallel, and merged back in.
+    '''
+    async def fetch(params: dict):
+        return await (_stream_power(params) if stream else make_request(SOLAR_API, params))
+
+    try:
+        start, end = date.fromisoformat(start_date[:10]), date.fromisoformat(end_date[:10])
+    except ValueError:
+        start = end = None
+    if power_series is None or start is None or end < start:
+        return _power_block(await fetch(_power_params(lat, lon, start_date.replace("-",""), end_date.replace("-",""))))
+
+    loc = power_series.location(lat, lon)
+    gaps = power_series.missing(loc, POWER_PARAMS, start, end)
+    fetched = await _fetch_all(*[
+        fetch(_power_params(loc[0], loc[1], a.strftime("%Y%m%d"), b.strftime("%Y%m%d"))) for a, b in gaps
+    ])
+
+    blocks = [_power_block(power) for power in fetched]
+    if any(block is None for block in blocks):
+        return None
+    final_before = date.today() - timedelta(days=POWER_FINAL_AFTER_DAYS)
+    merged = power_series.get(loc, POWER_PARAMS, start, end)
+    for block in blocks:
+        power_series.put(loc, block, final_before)
+        # recent or fill days are not stored but still belong in this answer
+        for name, series in block.items():
+            if isinstance(series, dict):
+                merged.setdefault(name, {}).update(series)
+    return merged
+
+def _alert_days(alerts) -> set[str]:
+    # DONKI issue times are ISO timestamps, POWER keys days as YYYYMMDD
+    return {a["messageIssueTime"][:10].replace("-", "") for a in _safe_list(alerts)
+            if isinstance(a, dict) and isinstance(a.get("messageIssueTime"), str)}
+
+def _score_days(sw: dict, pr: dict, alert_days: set[str]) -> tuple[list[str], np.ndarray, np.ndarray]:
+    '''
+    Score every day of a POWER window in one array pass: irradiance / 8 minus a
+    precipitation penalty (capped at 1) and 0.3 on space-weather alert days, floored
+    at -1. Returns (days in date order, alert mask, scores rounded to 3 decimals).
+    '''
+    days = sorted(set(sw.keys())|set(pr.keys()))
+    ssw = np.array([float(sw.get(day, 0.0)) for day in days], dtype=np.float64)
+    p = np.array([float(pr.get(day, 0.0)) for day in days], dtype=np.float64)
+    alert = np.array([day in alert_days for day in days], dtype=bool)
+
+    penalty = np.where(alert, 0.3, 0.0) + np.minimum(p/20.0, 1.0)
+    score = np.maximum(ssw/8.0 - penalty, -1.0)
+    # python's round, not np.round, so scores match the JSON the tool always produced
+    return days, alert, np.array([round(x, 3) for x in score.tolist()], dtype=np.float64)
+
+def _top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    '''
+    Indices of the k highest scores, best first, ties kept in input order like a
+    stable sort would. Uses a partial selection instead of sorting everything.
+    '''
+    n = len(scores)
+    if n > k > 0:
+        kth = np.partition(scores, n - k)[n - k]
+        cand = np.flatnonzero(scores >= kth)
+    else:
+        cand = np.arange(n)
+    return cand[np.lexsort((cand, -scores[cand]))][:max(k, 0)]
+
+def _solar_rows(days: list[str], sw: dict, pr: dict, alert: np.ndarray, scores: np.ndarray, idx) -> list[dict]:
+    return [{
+        "date": days[i],
+        "solar_irradiance": sw.get(days[i]),
+        "precip": pr.get(days[i]),
+        "space_weather_ok": not alert[i],
+        "score": float(scores[i])
+    } for i in idx]
+
+@mcp.tool()
+async def solar_weather(input: SolarWindow):
+    """Rank dates by solar potential and low precip; exclude severe space weather."""
+
+    d, alerts = await _fetch_all(
+        _power_window(input.lat, input.lon, input.start_date, input.end_date, _want_stream(input.stream)),
+        make_request(
+            DONKI_API,
+            params={"startDate":input.start_date,"endDate":input.end_date,"api_key":NASA_KEY}
+        ),
+    )
+    if not isinstance(d, dict):
+        empty = _shape([], input.format)
+        return {"windows": empty, "all": empty, "error": "POWER unavailable"}
     sw = d.get("ALLSKY_SFC_SW_DWN",{})
     pr = d.get("PRECTOTCORR",{})
 
+    # without DONKI we still rank by weather, but say so instead of claiming every day is ok
+    notes = []
+    if not isinstance(alerts, list):
+        notes.append("DONKI unavailable, space weather not checked")
 
-    alerts = await make_request(
-        DONKI_API,
-        params={"startDate":input.start_date,"endDate":input.end_date,"api_key":NASA_KEY}
+    days, alert, scores = _score_days(sw, pr, _alert_days(alerts))
+    # "all" stays in date order, only the best windows get ranked
+    out = {
+        "windows": _shape(_solar_rows(days, sw, pr, alert, scores, _top_k(scores, 7)), input.format, input.precision),
+        "all": _shape(_solar_rows(days, sw, pr, alert, scores, range(len(days))), input.format, input.precision)
+    }
+    if notes:
+        out["notes"] = notes
+    return out
+
+
+@mcp.tool()
+async def rank_solar_sites(input: SolarSites) -> dict:
+    """Rank (site, date) pairs by solar potential and low precip across many sites at once."""
+    logging.info("Using tool rank_solar_sites (%d sites)", len(input.sites))
+    limit = asyncio.Semaphore(SOLAR_SITE_CONCURRENCY)
+
+    async def _site_window(site: SolarSite):
+        async with limit:
+            return await _power_window(site.lat, site.lon, input.start_date, input.end_date)
+
+    alerts, *windows = await _fetch_all(
+        make_request(
+            DONKI_API,
+            params={"startDate":input.start_date,"endDate":input.end_date,"api_key":NASA_KEY}
+        ),
+        *[_site_window(site) for site in input.sites],
     )
-    alert_days = {a["messageIssueTime"][:10] for a in alerts if "messageIssueTime" in a}
-
-    def _score(day):
-        ssw = float(sw.get(day, 0.0))        
-        p = float(pr.get(day, 0.0))           
-        penalty = 0.0
-        if day in alert_days: 
-            penalty += 0.3  
-        penalty += min(p/20.0, 1.0)           
-        raw = (ssw / 8.0)                     
-        return max(raw - penalty, -1.0)
-
-    rows=[]
-    for day in sorted(set(sw.keys())|set(pr.keys())):
-        rows.append({
-            "date": day,
-            "solar_irradiance": sw.get(day),
-            "precip": pr.get(day),
-            "space_weather_ok": day not in alert_days,
-            "score": round(_score(day), 3)
-        })
-    rows.sort(key=lambda r: r["score"], reverse=True)
-    return {"windows": rows[:7], "all": rows}
+    notes = []
+    if not isinstance(alerts, list):
+        notes.append("DONKI unavailable, space weather not checked")
+    alert_days = _alert_days(alerts)
+
+    # score each site as a column block, then one top-k over every (site, date) pair
+    keys, blocks, failed = [], [], []
+    for i, (site, d) in enumerate(zip(input.sites, windows)):
+        key = site.id or f"{site.lat},{site.lon}"
+        if key in keys or key in failed:
+            key = f"{key}#{i}"
+        if not isinstance(d, dict):
+            failed.append(key)
+            continue
+        sw, pr = d.get("ALLSKY_SFC_SW_DWN",{}), d.get("PRECTOTCORR",{})
+        keys.append(key)
+        blocks.append((sw, pr, *_score_days(sw, pr, alert_days)))
 
+    if not blocks:
+        return {"ranking": [], "failed_sites": failed, "error": "POWER unavailable"}
+    owner = np.concatenate([np.full(len(b[2]), n, dtype=np.int64) for n, b in enumerate(blocks)])
+    pos = np.concatenate([np.arange(len(b[2]), dtype=np.int64) for b in blocks])
+    scores = np.concatenate([b[4] for b in blocks])
 
+    ranking = []
+    for i in _top_k(scores, input.top_k):
+        sw, pr, days, alert, site_scores = blocks[owner[i]]
+        row = _solar_rows(days, sw, pr, alert, site_scores, [pos[i]])[0]
+        ranking.append({"site": keys[owner[i]], **row})
 
+    out = {"ranking": ranking}
+    if failed:
+        out["failed_sites"] = failed
+    if notes:
+        out["notes"] = notes
+    return out
+
+
+
+
+@mcp.resource("stats://upstream")
+def upstream_stats() -> str:
+    """Cache and request-coalescing counters for the NASA upstreams."""
+    return json.dumps(upstream.stats(), indent=2)
+
+
+@mcp.resource("stats://power-store")
+def power_store_stats() -> str:
+    """Cells, stored values and locally served days of the POWER time-series store."""
+    return json.dumps(power_series.stats() if power_series else {"enabled": False}, indent=2)
 
-async def make_request(url: str, params: Optional[dict[str, Any]] = None) -> dict[str, Any] | None:
-    '''
-    Helper function to make requests to the API
-    '''
-    async with httpx.AsyncClient(                    
-        timeout=httpx.Timeout(25.0),
-        headers=DEFAULT_HEADERS,
-        transport=httpx.AsyncHTTPTransport(retries=2),               
-        follow_redirects=True,
-    ) as client:
-        try:
-            response = await client.get(url, params=params)
-            response.raise_for_status()
- 
-            return response.json()
-        except httpx.RemoteProtocolError as e:
-            logging.error("RemoteProtocolError for %s: %r", response.request.url if 'r' in locals() else url, e)
-            return None
-        except httpx.HTTPStatusError as e:
-            resp = e.response
-            logging.error("HTTP %s for %s\nHeaders: %s\nBody: %s",
-                          resp.status_code, resp.request.url, dict(resp.headers), resp.text[:500])
-            return None
-        except json.JSONDecodeError as e:
-            logging.error("JSON decode error for %s: %r (first 200 chars: %s)",
-                          response.request.url if 'r' in locals() else url, e, (response.text[:200] if 'r' in locals() else ""))
-            return None
-        except httpx.RequestError as e:
-            logging.error("RequestError for %s: %r", url, e)
-            return None
-        except Exception as e:
-            logging.error("Unexpected error for %s: %r", url, e)
-            return None
 
-    
+@mcp.resource("stats://hazard-index")
+def hazard_index_stats() -> str:
+    """Size, build time and query latency of the in-memory EONET index."""
+    return json.dumps(hazard_idx.stats(), indent=2)
 
 
 def main():
@@ -0,0 +1,252 @@
+'''
+Local catalog of TLE records for cloud_server.
+
+Records live in SQLite keyed by satelliteId, with an FTS5 index on the name so a
+search is a local index lookup instead of a round-trip to the TLE API. A background
+task pages through the whole API now and then and bulk-upserts the records; entries
+that disappeared upstream are dropped once a full pass has completed. When several
+worker processes share one catalog file, a lease row makes sure only one of them
+runs the refresh.
+'''
+from typing import Any, AsyncIterator, Callable
+import asyncio
+import logging
+import os
+import re
+import socket
+import sqlite3
+import time
+
+
+_FIELDS = ("satelliteId", "name", "date", "line1", "line2")
+
+
+def _fts5_available(db: sqlite3.Connection) -> bool:
+    try:
+        db.execute("CREATE VIRTUAL TABLE temp._fts5_probe USING fts5(x)")
+        db.execute("DROP TABLE temp._fts5_probe")
+        return True
+    except sqlite3.OperationalError:
+        return False
+
+
+class TleCatalog:
+    '''
+    SQLite-backed satelliteId -> TLE record store with prefix search on the name
+    '''
+    def __init__(self, db_path: str = ":memory:") -> None:
+        if db_path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS tle ("
+            " satellite_id INTEGER PRIMARY KEY, name TEXT NOT NULL, date TEXT, line1 TEXT, line2 TEXT,"
+            " generation INTEGER NOT NULL DEFAULT 0)"
+        )
+        self._db.execute("CREATE TABLE IF NOT EXISTS tle_meta (key TEXT PRIMARY KEY, value TEXT)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS tle_lease (name TEXT PRIMARY KEY, owner TEXT, expires REAL)")
+        # external-content FTS table kept in sync by triggers, prefix indexes make "ISS*" cheap
+        self.fts = _fts5_available(self._db)
+        if self.fts:
+            self._db.executescript('''
+                CREATE VIRTUAL TABLE IF NOT EXISTS tle_fts USING fts5(
+                    name, content='tle', content_rowid='satellite_id', prefix='2 3 4'
+                );
+                CREATE TRIGGER IF NOT EXISTS tle_ai AFTER INSERT ON tle BEGIN
+                    INSERT INTO tle_fts(rowid, name) VALUES (new.satellite_id, new.name);
+                END;
+                CREATE TRIGGER IF NOT EXISTS tle_ad AFTER DELETE ON tle BEGIN
+                    INSERT INTO tle_fts(tle_fts, rowid, name) VALUES ('delete', old.satellite_id, old.name);
+                END;
+                CREATE TRIGGER IF NOT EXISTS tle_au AFTER UPDATE OF name ON tle WHEN old.name IS NOT new.name BEGIN
+                    INSERT INTO tle_fts(tle_fts, rowid, name) VALUES ('delete', old.satellite_id, old.name);
+                    INSERT INTO tle_fts(rowid, name) VALUES (new.satellite_id, new.name);
+                END;
+            ''')
+        else:
+            logging.warning("SQLite has no FTS5, TLE name search falls back to LIKE")
+            self._db.execute("CREATE INDEX IF NOT EXISTS tle_name ON tle (name COLLATE NOCASE)")
+        self._db.commit()
+        self.searches = 0
+        self.lookups = 0
+        self.last_refresh_ms: float | None = None
+
+    def close(self) -> None:
+        self._db.close()
+
+    @property
+    def ready(self) -> bool:
+        # only a completed refresh pass makes the catalog complete: rows stored by id
+        # lookups or by a pass still running would turn searches into false misses
+        return self._meta("refreshed_at") is not None
+
+    def _meta(self, key: str) -> str | None:
+        row = self._db.execute("SELECT value FROM tle_meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def generation(self) -> int:
+        return int(self._meta("generation") or 0)
+
+    def upsert(self, members: list, generation: int | None = None) -> int:
+        '''
+        Insert or replace TLE records (API "member" dicts), returns how many were stored
+        '''
+        gen = self.generation() if generation is None else generation
+        rows = []
+        for m in members:
+            if not isinstance(m, dict):
+                continue
+            try:
+                sat_id = int(m.get("satelliteId"))
+            except (TypeError, ValueError):
+                continue
+            rows.append((sat_id, str(m.get("name") or ""), m.get("date"), m.get("line1"), m.get("line2"), gen))
+        # ON CONFLICT keeps the rowid stable so the FTS triggers only fire when the name changes
+        self._db.executemany(
+            "INSERT INTO tle (satellite_id, name, date, line1, line2, generation) VALUES (?, ?, ?, ?, ?, ?)"
+            " ON CONFLICT (satellite_id) DO UPDATE SET name = excluded.name, date = excluded.date,"
+            " line1 = excluded.line1, line2 = excluded.line2, generation = excluded.generation",
+            rows,
+        )
+        self._db.commit()
+        return len(rows)
+
+    def finish_refresh(self, generation: int) -> int:
+        '''
+        A full pass stored everything under `generation`: drop what it did not see
+        '''
+        dropped = self._db.execute("DELETE FROM tle WHERE generation < ?", (generation,)).rowcount
+        self._db.execute("INSERT OR REPLACE INTO tle_meta VALUES ('generation', ?)", (str(generation),))
+        self._db.execute("INSERT OR REPLACE INTO tle_meta VALUES ('refreshed_at', ?)", (str(time.time()),))
+        self._db.commit()
+        return dropped
+
+    def refresh_age(self) -> float | None:
+        # seconds since the last completed refresh, by any process sharing the file
+        refreshed = self._meta("refreshed_at")
+        return None if refreshed is None else time.time() - float(refreshed)
+
+    def acquire_lease(self, owner: str, ttl_s: float, name: str = "refresh") -> bool:
+        '''
+        Take or renew the named lease for ttl_s seconds. Only succeeds when nobody
+        holds it or it expired, one statement so concurrent workers cannot both win.
+        '''
+        now = time.time()
+        cur = self._db.execute(
+            "INSERT INTO tle_lease (name, owner, expires) VALUES (?, ?, ?)"
+            " ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, expires = excluded.expires"
+            " WHERE tle_lease.owner = excluded.owner OR tle_lease.expires < ?",
+            (name, owner, now + ttl_s, now),
+        )
+        self._db.commit()
+        return cur.rowcount == 1
+
+    def release_lease(self, owner: str, name: str = "refresh") -> None:
+        self._db.execute("DELETE FROM tle_lease WHERE name = ? AND owner = ?", (name, owner))
+        self._db.commit()
+
+    def _record(self, row: tuple) -> dict[str, Any]:
+        return dict(zip(_FIELDS, row))
+
+    def get(self, sat_id) -> dict[str, Any] | None:
+        self.lookups += 1
+        try:
+            sat_id = int(sat_id)
+        except (TypeError, ValueError):
+            return None
+        row = self._db.execute(
+            "SELECT satellite_id, name, date, line1, line2 FROM tle WHERE satellite_id = ?", (sat_id,)
+        ).fetchone()
+        return self._record(row) if row else None
+
+    def search(self, name: str, limit: int | None = None) -> list[dict[str, Any]]:
+        '''
+        Records whose name has a word starting with every word of `name`, ordered by
+        satelliteId. An empty query matches everything.
+        '''
+        self.searches += 1
+        terms = re.findall(r"\w+", name or "")
+        cols = "t.satellite_id, t.name, t.date, t.line1, t.line2"
+        lim = "" if limit is None else f" LIMIT {int(limit)}"
+        if not terms:
+            rows = self._db.execute(f"SELECT {cols} FROM tle t ORDER BY t.satellite_id{lim}")
+        elif self.fts:
+            match = " AND ".join(f'"{t}"*' for t in terms)
+            rows = self._db.execute(
+                f"SELECT {cols} FROM tle_fts f JOIN tle t ON t.satellite_id = f.rowid"
+                f" WHERE tle_fts MATCH ? ORDER BY t.satellite_id{lim}",
+                (match,),
+            )
+        else:
+            where = " AND ".join("t.name LIKE ?" for _ in terms)
+            rows = self._db.execute(
+                f"SELECT {cols} FROM tle t WHERE {where} ORDER BY t.satellite_id{lim}",
+                [f"%{t}%" for t in terms],
+            )
+        return [self._record(r) for r in rows]
+
+    def stats(self) -> dict[str, Any]:
+        age = self.refresh_age()
+        lease = self._db.execute("SELECT owner, expires FROM tle_lease WHERE name = 'refresh'").fetchone()
+        return {
+            "records": self._db.execute("SELECT COUNT(*) FROM tle").fetchone()[0],
+            "fts5": self.fts,
+            "generation": self.generation(),
+            "last_refresh_age_s": None if age is None else round(age, 1),
+            "refresh_lease": None if lease is None else {"owner": lease[0], "expires_in_s": round(lease[1] - time.time(), 1)},
+            "last_refresh_ms": None if self.last_refresh_ms is None else round(self.last_refresh_ms, 2),
+            "searches": self.searches,
+            "lookups": self.lookups,
+        }
+
+
+async def keep_fresh(
+    catalog: TleCatalog,
+    fetch_pages: Callable[[], AsyncIterator[list]],
+    interval_s: float,
+    lease_poll_s: float = 300,
+) -> None:
+    '''
+    Every `interval_s` seconds walk the whole TLE API with fetch_pages() (an async
+    iterator of "member" lists, raising if a page fails or the walk ends short) and
+    bulk-upsert every page.
+    A pass that fails part way keeps what it stored but does not drop anything.
+
+    Only the holder of the catalog's refresh lease does the work; other processes
+    sharing the file check every lease_poll_s whether the holder went away. The lease
+    lasts a few lease_poll_s and the holder renews it on every page and every wake-up,
+    so a crashed holder blocks the others for minutes, not a whole interval. A catalog
+    refreshed less than interval_s ago (e.g. by a previous run) is not refreshed again.
+    '''
+    owner = f"{socket.gethostname()}:{os.getpid()}"
+    lease_s = 3 * lease_poll_s
+    try:
+        while True:
+            if not catalog.acquire_lease(owner, lease_s):
+                await asyncio.sleep(min(interval_s, lease_poll_s))
+                continue
+            age = catalog.refresh_age()
+            if age is not None and 0 <= age < interval_s:
+                await asyncio.sleep(min(interval_s - age, lease_poll_s))
+                continue
+
+            stored = 0
+            try:
+                t0 = time.perf_counter()
+                gen = catalog.generation() + 1
+                async for members in fetch_pages():
+                    if not catalog.acquire_lease(owner, lease_s):
+                        # a page stalled past the lease and another worker took over
+                        raise RuntimeError("refresh lease lost")
+                    stored += catalog.upsert(members, gen)
+                dropped = catalog.finish_refresh(gen)
+                catalog.last_refresh_ms = (time.perf_counter() - t0) * 1000
+                logging.info("TLE catalog refreshed: %d records, %d dropped, %s", stored, dropped, catalog.stats())
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error("TLE catalog refresh failed after %d records: %r", stored, e)
+            await asyncio.sleep(min(interval_s, lease_poll_s))
+    finally:
+        catalog.release_lease(owner)
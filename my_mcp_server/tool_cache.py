@@ -0,0 +1,127 @@
+'''
+Memoized MCP tool results for the client.
+
+Within one conversation the model often repeats a call with the same arguments (the
+same hazards query, the same directory listing). Results of tools on the allowlist are
+kept for a per-tool TTL, keyed on (server prefix, tool, canonical JSON of the arguments),
+in a size-bounded LRU. Identical calls that run at the same time share one request.
+A call to a tool that is not on the allowlist may change state on that server, so it
+drops every cached result of that server.
+'''
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable
+import asyncio
+import json
+import time
+
+
+def parse_allowlist(spec: str) -> dict[str, float]:
+    '''
+    "list_hazards=600,fs.read_file=30" -> {tool: ttl_s}. A name without a prefix
+    matches that tool on every server.
+    '''
+    out = {}
+    for item in spec.split(","):
+        name, _, ttl = item.strip().partition("=")
+        if not name:
+            continue
+        try:
+            out[name] = float(ttl) if ttl else 60.0
+        except ValueError:
+            continue
+    return out
+
+
+class ToolResultCache:
+    '''
+    LRU of tool results keyed on (prefix, tool, args)
+    '''
+    def __init__(self, allowlist: dict[str, float], max_entries: int = 256) -> None:
+        self.allowlist = allowlist
+        self.max_entries = max_entries
+        self._lru: OrderedDict[tuple, tuple[float, Any]] = OrderedDict()
+        self._inflight: dict[tuple, asyncio.Future] = {}
+        self._waiters: dict[tuple, int] = {}
+        # bumped by invalidate(), a result fetched across a bump is not stored
+        self._gen: dict[str, int] = {}
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def ttl(self, prefix: str, tool: str) -> float | None:
+        ttl = self.allowlist.get(f"{prefix}.{tool}")
+        return self.allowlist.get(tool) if ttl is None else ttl
+
+    def invalidate(self, prefix: str) -> None:
+        for key in [k for k in self._lru if k[0] == prefix]:
+            del self._lru[key]
+        self._gen[prefix] = self._gen.get(prefix, 0) + 1
+        for key in [k for k in self._inflight if k[0] == prefix]:
+            del self._inflight[key]
+            del self._waiters[key]
+        self.invalidations += 1
+
+    async def call(self, prefix: str, tool: str, arguments: dict, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        ttl = self.ttl(prefix, tool)
+        if ttl is None:
+            self.invalidate(prefix)
+            return await fetch()
+        try:
+            key = (prefix, tool, json.dumps(arguments or {}, sort_keys=True, separators=(",", ":")))
+        except (TypeError, ValueError):
+            return await fetch()
+
+        entry = self._lru.get(key)
+        if entry is not None:
+            if entry[0] > time.monotonic():
+                self._lru.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            del self._lru[key]
+        task = self._inflight.get(key)
+        if task is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            # the fetch is a task of its own: a caller timing out or being cancelled
+            # must not take the shared call down with it for everyone else
+            task = asyncio.ensure_future(self._fetch(key, ttl, fetch))
+            self._inflight[key] = task
+            self._waiters[key] = 0
+            task.add_done_callback(lambda t: self._forget(key, t))
+        self._waiters[key] += 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            # the last caller giving up stops the call
+            if self._inflight.get(key) is task:
+                self._waiters[key] -= 1
+                if self._waiters[key] == 0:
+                    self._forget(key, task)
+                    task.cancel()
+            raise
+
+    async def _fetch(self, key: tuple, ttl: float, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        gen = self._gen.get(key[0], 0)
+        result = await fetch()
+        # errors are worth retrying, only keep real results
+        if not getattr(result, "isError", False) and self._gen.get(key[0], 0) == gen:
+            self._lru[key] = (time.monotonic() + ttl, result)
+            while len(self._lru) > self.max_entries:
+                self._lru.popitem(last=False)
+        return result
+
+    def _forget(self, key: tuple, task: asyncio.Future) -> None:
+        # a later call may already own the key
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+            del self._waiters[key]
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "entries": len(self._lru),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+        }
@@ -0,0 +1,698 @@
+'''
+Shared HTTP plumbing for the MCP servers (server.py and cloud_server.py).
+
+One pooled httpx.AsyncClient lives for the whole process: it is opened by the
+FastMCP lifespan at startup and closed at shutdown, so every NASA / TLE fetch
+reuses warm keep-alive connections instead of paying DNS + TCP + TLS each call.
+On top of it sit a TTL/LRU response cache and single-flight coalescing of identical
+in-flight requests. Every request also goes through a per-host guard: a token-bucket
+rate limiter, an in-flight cap, jittered retries on 429/5xx and a circuit breaker that
+stops calling an upstream that keeps failing (cached responses are served stale meanwhile).
+'''
+import httpx
+from typing import Any, AsyncIterator, Callable, Optional
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from urllib.parse import urlsplit
+from email.utils import parsedate_to_datetime
+import asyncio
+import atexit
+import importlib.util
+import json
+import logging
+import math
+import os
+import random
+import sqlite3
+import time
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+
+# keep-alive is the whole point of the shared client, so no "Connection: close" here
+DEFAULT_HEADERS = {
+    "Accept": "application/json",
+    "User-Agent": "Mozilla/5.0 (compatible; mcp-client/1.0; +https://example.com)",
+}
+
+# per-upstream read timeouts in seconds (POWER is notoriously slow on long ranges)
+UPSTREAM_TIMEOUTS: dict[str, float] = {
+    "eonet.gsfc.nasa.gov": 30.0,
+    "api.nasa.gov": 25.0,
+    "power.larc.nasa.gov": 60.0,
+    "tle.ivanstanojevic.me": 15.0,
+}
+DEFAULT_TIMEOUT = 25.0
+CONNECT_TIMEOUT = 10.0
+
+# pool settings, overridable from the environment
+MAX_CONNECTIONS = int(os.getenv("MCP_HTTP_MAX_CONNECTIONS", "20"))
+MAX_KEEPALIVE = int(os.getenv("MCP_HTTP_MAX_KEEPALIVE", "10"))
+KEEPALIVE_EXPIRY = float(os.getenv("MCP_HTTP_KEEPALIVE_EXPIRY", "30"))
+HTTP2 = os.getenv("MCP_HTTP2", "0") == "1"
+
+# per-upstream token buckets as (requests per second, burst). api.nasa.gov allows
+# 1000 requests/hour for a real key (and far fewer for DEMO_KEY), the others publish
+# no limit so stay polite. Override with MCP_RATE_LIMITS="host=rate:burst,host=rate:burst"
+UPSTREAM_RATES: dict[str, tuple[float, float]] = {
+    "api.nasa.gov": (1000 / 3600, 10),
+    "eonet.gsfc.nasa.gov": (5.0, 10),
+    "power.larc.nasa.gov": (2.0, 5),
+    "tle.ivanstanojevic.me": (5.0, 10),
+}
+DEFAULT_RATE = (10.0, 20)
+MAX_IN_FLIGHT = int(os.getenv("MCP_HTTP_MAX_IN_FLIGHT", "4"))
+# retries on 429/5xx and transport errors, with full-jitter exponential backoff
+RETRIES = int(os.getenv("MCP_HTTP_RETRIES", "3"))
+RETRY_BASE_S = float(os.getenv("MCP_RETRY_BASE_S", "0.5"))
+RETRY_MAX_DELAY_S = float(os.getenv("MCP_RETRY_MAX_DELAY_S", "8"))
+# a Retry-After longer than this is not waited out inside a tool call, the host is paused instead
+RETRY_AFTER_MAX_S = float(os.getenv("MCP_RETRY_AFTER_MAX_S", "30"))
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# consecutive failed requests before the breaker opens, and how long it stays open
+BREAKER_FAILURES = int(os.getenv("MCP_BREAKER_FAILURES", "5"))
+BREAKER_COOLDOWN_S = float(os.getenv("MCP_BREAKER_COOLDOWN_S", "30"))
+
+
+def _parse_rates(spec: str) -> dict[str, tuple[float, float]]:
+    rates = {}
+    for part in spec.split(","):
+        host, _, value = part.strip().partition("=")
+        if not host or not value:
+            continue
+        try:
+            rate, _, burst = value.partition(":")
+            rates[host] = (float(rate), float(burst or 1))
+        except ValueError:
+            logging.warning("Ignoring bad MCP_RATE_LIMITS entry %r", part)
+    return rates
+
+UPSTREAM_RATES.update(_parse_rates(os.getenv("MCP_RATE_LIMITS", "")))
+# the limits above are for the whole deployment: every process sharing them (e.g. the
+# cloud_server workers, which set this) gets an equal share of each bucket
+RATE_SHARES = max(1, int(os.getenv("MCP_RATE_SHARES", "1")))
+
+_client: httpx.AsyncClient | None = None
+# FastMCP enters the lifespan once per session (once per process for stdio, once per
+# client for streamable-http), so the client is refcounted rather than tied to one session
+_lifespan_users = 0
+
+
+_MISS = object()
+
+# single-flight table: normalized request key -> the fetch currently running for it
+_inflight: dict[str, asyncio.Future] = {}
+# callers currently awaiting each in-flight fetch
+_waiters: dict[str, int] = {}
+_coalesced = 0
+
+# a TTL rule is either seconds (math.inf = never expires) or a callable deciding per request
+TTLRule = float | Callable[[dict[str, Any]], float]
+
+
+class ResponseCache:
+    '''
+    TTL + LRU cache for decoded upstream responses, keyed on (url, sorted params).
+
+    Entries live in a bounded in-memory LRU; when a SQLite path is given every entry
+    is also written there, so a restarted server starts warm and misses in memory
+    fall back to disk. Cached payloads are shared between callers: treat them as read-only.
+    '''
+    def __init__(self, max_entries: int = 512, db_path: str | None = None) -> None:
+        self.max_entries = max_entries
+        self._lru: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+        self._ttl_rules: dict[str, TTLRule] = {}
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self.stale_hits = 0
+        self._db: sqlite3.Connection | None = None
+        if db_path:
+            self._open_db(db_path)
+
+    def _open_db(self, db_path: str) -> None:
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, expires REAL, body TEXT NOT NULL)"
+        )
+        # expired rows are useless after a restart
+        self._db.execute("DELETE FROM responses WHERE expires IS NOT NULL AND expires < ?", (time.time(),))
+        self._db.commit()
+
+    def close(self) -> None:
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    @staticmethod
+    def key(url: str, params: Optional[dict[str, Any]] = None) -> str:
+        items = sorted((str(k), str(v)) for k, v in (params or {}).items())
+        return json.dumps([url, items], separators=(",", ":"))
+
+    def set_ttl(self, url_prefix: str, ttl: TTLRule) -> None:
+        '''
+        Register the TTL for every URL starting with url_prefix (longest prefix wins)
+        '''
+        self._ttl_rules[url_prefix] = ttl
+
+    def ttl_for(self, url: str, params: Optional[dict[str, Any]] = None) -> float:
+        best = None
+        for prefix in self._ttl_rules:
+            if url.startswith(prefix) and (best is None or len(prefix) > len(best)):
+                best = prefix
+        if best is None:
+            return 0.0
+        rule = self._ttl_rules[best]
+        return float(rule(params or {})) if callable(rule) else float(rule)
+
+    def get(self, key: str) -> Any:
+        now = time.time()
+        entry = self._lru.get(key)
+        if entry is not None:
+            expires, value = entry
+            # expired entries stay in the LRU until evicted, get_stale may still need them
+            if expires >= now:
+                self._lru.move_to_end(key)
+                self.hits += 1
+                return value
+
+        if self._db is not None:
+            row = self._db.execute("SELECT expires, body FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                expires = math.inf if row[0] is None else row[0]
+                if expires >= now:
+                    value = json.loads(row[1])
+                    self._remember(key, expires, value)
+                    self.hits += 1
+                    self.disk_hits += 1
+                    return value
+
+        self.misses += 1
+        return _MISS
+
+    def get_stale(self, key: str) -> Any:
+        '''
+        Last stored value for key even if it expired, for when the upstream is down
+        '''
+        entry = self._lru.get(key)
+        if entry is not None:
+            self.stale_hits += 1
+            return entry[1]
+        if self._db is not None:
+            row = self._db.execute("SELECT body FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                self.stale_hits += 1
+                return json.loads(row[0])
+        return _MISS
+
+    def put(self, key: str, value: Any, ttl: float) -> None:
+        expires = time.time() + ttl
+        self._remember(key, expires, value)
+        if self._db is not None:
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses (key, expires, body) VALUES (?, ?, ?)",
+                (key, None if math.isinf(expires) else expires, json.dumps(value, separators=(",", ":"))),
+            )
+            self._db.commit()
+
+    def _remember(self, key: str, expires: float, value: Any) -> None:
+        self._lru[key] = (expires, value)
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.max_entries:
+            self._lru.popitem(last=False)
+
+    def stats(self) -> dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._lru),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "stale_hits": self.stale_hits,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+            "persistent": self._db is not None,
+        }
+
+
+cache = ResponseCache(
+    max_entries=int(os.getenv("MCP_CACHE_MAX_ENTRIES", "512")),
+    db_path=os.getenv("MCP_CACHE_DB") or None,
+)
+atexit.register(cache.close)
+
+
+class HostGuard:
+    '''
+    Traffic control for one upstream host: a token bucket (rate, burst), a cap on
+    concurrent requests and a circuit breaker.
+
+    The breaker opens after BREAKER_FAILURES consecutive failed requests and then
+    fails fast for BREAKER_COOLDOWN_S; after that one probe request is let through
+    (half-open) and its outcome closes or re-opens the breaker.
+    '''
+    def __init__(self, host: str, rate: float, burst: float, max_in_flight: int) -> None:
+        self.host = host
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._refilled = time.monotonic()
+        self._paused_until = 0.0
+        self._sem = asyncio.Semaphore(max_in_flight)
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self._open_until = 0.0
+        self._probing = False
+        self.requests = 0
+        self.failures = 0
+        self.retries = 0
+        self.throttled = 0
+        self.throttled_s = 0.0
+        self.short_circuited = 0
+
+    def allow(self) -> bool:
+        '''
+        Whether a request may be sent now, as far as the breaker is concerned
+        '''
+        if self.state == "open":
+            if time.monotonic() < self._open_until:
+                self.short_circuited += 1
+                return False
+            self.state = "half_open"
+            self._probing = False
+        if self.state == "half_open":
+            if self._probing:
+                self.short_circuited += 1
+                return False
+            self._probing = True
+        return True
+
+    def record_success(self) -> None:
+        if self.state != "closed":
+            logging.info("Circuit for %s closed", self.host)
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self._probing = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        self.consecutive_failures += 1
+        self._probing = False
+        if self.state == "half_open" or (self.state == "closed" and self.consecutive_failures >= BREAKER_FAILURES):
+            logging.warning("Circuit for %s open for %ss after %d failures",
+                            self.host, BREAKER_COOLDOWN_S, self.consecutive_failures)
+            self.trip(BREAKER_COOLDOWN_S)
+
+    def trip(self, seconds: float) -> None:
+        # open the breaker for `seconds`, also used when a Retry-After is too long to wait out
+        self.state = "open"
+        self._open_until = max(self._open_until, time.monotonic() + seconds)
+
+    def release_probe(self) -> None:
+        # a half-open probe that ended without an outcome (cancelled) lets the next one through
+        self._probing = False
+
+    def pause(self, seconds: float) -> None:
+        # the upstream asked us to back off (Retry-After), hold every request to it.
+        # Longer waits than RETRY_AFTER_MAX_S trip the breaker instead of queueing callers
+        if seconds > RETRY_AFTER_MAX_S:
+            logging.warning("%s asked to retry after %.0fs, failing fast until then", self.host, seconds)
+            self.trip(seconds)
+            return
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def _take_token(self) -> None:
+        waited = False
+        while True:
+            now = time.monotonic()
+            wait = self._paused_until - now
+            if wait <= 0:
+                self._tokens = min(self.burst, self._tokens + (now - self._refilled) * self.rate)
+                self._refilled = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            if not waited:
+                self.throttled += 1
+                waited = True
+            self.throttled_s += wait
+            await asyncio.sleep(wait)
+
+    @asynccontextmanager
+    async def slot(self):
+        '''
+        Hold an in-flight slot and spend one token for the duration of a request
+        '''
+        async with self._sem:
+            await self._take_token()
+            self.in_flight += 1
+            self.requests += 1
+            try:
+                yield
+            finally:
+                self.in_flight -= 1
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "state": self.state,
+            "open_for_s": round(max(0.0, self._open_until - time.monotonic()), 1) if self.state == "open" else 0.0,
+            "consecutive_failures": self.consecutive_failures,
+            "rate_per_s": round(self.rate, 4),
+            "burst": self.burst,
+            "tokens": round(min(self.burst, self._tokens + (time.monotonic() - self._refilled) * self.rate), 2),
+            "paused_for_s": round(max(0.0, self._paused_until - time.monotonic()), 1),
+            "in_flight": self.in_flight,
+            "max_in_flight": self.max_in_flight,
+            "requests": self.requests,
+            "failures": self.failures,
+            "retries": self.retries,
+            "throttled": self.throttled,
+            "throttled_s": round(self.throttled_s, 2),
+            "short_circuited": self.short_circuited,
+        }
+
+
+_guards: dict[str, HostGuard] = {}
+
+
+def host_guard(url: str) -> HostGuard:
+    host = urlsplit(url).hostname or ""
+    guard = _guards.get(host)
+    if guard is None:
+        rate, burst = UPSTREAM_RATES.get(host, DEFAULT_RATE)
+        guard = _guards[host] = HostGuard(host, rate / RATE_SHARES, max(1.0, burst / RATE_SHARES), MAX_IN_FLIGHT)
+    return guard
+
+
+def _retry_after(response: httpx.Response) -> float | None:
+    # Retry-After is either delta-seconds or an HTTP date
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def _backoff(attempt: int, retry_after: float | None) -> float:
+    # full jitter, but never sooner than the upstream asked for
+    delay = random.uniform(0, min(RETRY_MAX_DELAY_S, RETRY_BASE_S * 2 ** attempt))
+    return max(delay, retry_after or 0.0)
+
+
+def _timeout_for(url: str) -> httpx.Timeout:
+    host = urlsplit(url).hostname or ""
+    read = UPSTREAM_TIMEOUTS.get(host, DEFAULT_TIMEOUT)
+    return httpx.Timeout(read, connect=CONNECT_TIMEOUT)
+
+
+def _build_client() -> httpx.AsyncClient:
+    http2 = HTTP2
+    if http2 and importlib.util.find_spec("h2") is None:
+        # httpx only speaks HTTP/2 with the optional h2 package (pip install httpx[http2])
+        logging.warning("MCP_HTTP2=1 but the 'h2' package is not installed, using HTTP/1.1")
+        http2 = False
+    limits = httpx.Limits(
+        max_connections=MAX_CONNECTIONS,
+        max_keepalive_connections=MAX_KEEPALIVE,
+        keepalive_expiry=KEEPALIVE_EXPIRY,
+    )
+    return httpx.AsyncClient(
+        timeout=httpx.Timeout(DEFAULT_TIMEOUT, connect=CONNECT_TIMEOUT),
+        headers=DEFAULT_HEADERS,
+        transport=httpx.AsyncHTTPTransport(retries=2, limits=limits, http2=http2),
+        follow_redirects=True,
+    )
+
+
+async def open_client() -> httpx.AsyncClient:
+    '''
+    Create the shared client (idempotent)
+    '''
+    global _client
+    if _client is None or _client.is_closed:
+        _client = _build_client()
+        logging.info("Opened shared HTTP client (max_connections=%s, keepalive=%s, http2=%s)",
+                     MAX_CONNECTIONS, MAX_KEEPALIVE, HTTP2)
+    return _client
+
+
+async def close_client() -> None:
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        logging.info("Closed shared HTTP client")
+    _client = None
+
+
+async def get_client() -> httpx.AsyncClient:
+    # tools may run outside the lifespan (e.g. direct calls in a script), so open lazily
+    if _client is None or _client.is_closed:
+        return await open_client()
+    return _client
+
+
+@asynccontextmanager
+async def lifespan(server):
+    '''
+    FastMCP lifespan: open the pooled client at startup and close it at shutdown
+    '''
+    global _lifespan_users
+    _lifespan_users += 1
+    await open_client()
+    try:
+        yield
+    finally:
+        _lifespan_users -= 1
+        if _lifespan_users == 0:
+            await close_client()
+
+
+def stats() -> dict[str, Any]:
+    '''
+    Snapshot of the upstream layer, served by the servers as the stats://upstream resource
+    '''
+    return {
+        "cache": cache.stats(),
+        "single_flight": {"in_flight": len(_inflight), "coalesced": _coalesced},
+        "hosts": {host: guard.stats() for host, guard in _guards.items()},
+    }
+
+
+async def make_request(url: str, params: Optional[dict[str, Any]] = None, fresh: bool = False) -> dict[str, Any] | None:
+    '''
+    Helper function to make requests to the API, served from the response cache when
+    the endpoint has a TTL registered with cache.set_ttl. fresh=True always asks the
+    upstream (the answer is still cached for everyone else) and never falls back to a
+    stale entry.
+    '''
+    ttl = cache.ttl_for(url, params)
+    key = cache.key(url, params)
+    if ttl > 0 and not fresh:
+        data = cache.get(key)
+        if data is not _MISS:
+            return data
+    data = await _single_flight(key, url, params, ttl)
+    if data is None and ttl > 0 and not fresh:
+        # upstream failing or its circuit open: an expired answer beats no answer
+        stale = cache.get_stale(key)
+        if stale is not _MISS:
+            logging.warning("Serving stale cached response for %s", url)
+            return stale
+    return data
+
+
+async def _single_flight(key: str, url: str, params: Optional[dict[str, Any]], ttl: float) -> dict[str, Any] | None:
+    '''
+    Coalesce identical concurrent requests: the first caller starts the fetch and
+    everyone asking for the same key meanwhile awaits that same future
+    '''
+    global _coalesced
+    fut = _inflight.get(key)
+    if fut is None:
+        fut = asyncio.ensure_future(_fetch_and_store(key, url, params, ttl))
+        _inflight[key] = fut
+        _waiters[key] = 0
+        fut.add_done_callback(lambda f: _forget(key, f))
+    else:
+        _coalesced += 1
+    _waiters[key] += 1
+    try:
+        # shield so one caller giving up does not cancel the fetch for the others...
+        return await asyncio.shield(fut)
+    except asyncio.CancelledError:
+        # ...but once nobody waits for it any more, stop it instead of finishing it for no one
+        if _inflight.get(key) is fut:
+            _waiters[key] -= 1
+            if _waiters[key] == 0:
+                _forget(key, fut)
+                fut.cancel()
+        raise
+
+
+def _forget(key: str, fut: asyncio.Future) -> None:
+    # a later fetch may already own the key
+    if _inflight.get(key) is fut:
+        del _inflight[key]
+        del _waiters[key]
+
+
+async def _fetch_and_store(key: str, url: str, params: Optional[dict[str, Any]], ttl: float) -> dict[str, Any] | None:
+    data = await _fetch(url, params)
+    # failures come back as None and are never cached
+    if data is not None and ttl > 0:
+        cache.put(key, data, ttl)
+    return data
+
+
+async def _fetch(url: str, params: Optional[dict[str, Any]] = None) -> dict[str, Any] | None:
+    guard = host_guard(url)
+    if not guard.allow():
+        logging.warning("Circuit for %s is open, not calling %s", guard.host, url)
+        return None
+    try:
+        return await _fetch_with_retries(guard, url, params)
+    finally:
+        guard.release_probe()
+
+
+async def _fetch_with_retries(guard: HostGuard, url: str, params: Optional[dict[str, Any]]) -> dict[str, Any] | None:
+    client = await get_client()
+    for attempt in range(RETRIES + 1):
+        retry_after = None
+        try:
+            async with guard.slot():
+                response = await client.get(url, params=params, timeout=_timeout_for(url))
+            response.raise_for_status()
+
+            data = response.json()
+            guard.record_success()
+            return data
+        except httpx.HTTPStatusError as e:
+            resp = e.response
+            if resp.status_code not in RETRY_STATUSES:
+                # other 4xx are about our request, not the upstream's health
+                logging.error("HTTP %s for %s\nHeaders: %s\nBody: %s",
+                              resp.status_code, resp.request.url, dict(resp.headers), resp.text[:500])
+                guard.record_success()
+                return None
+            retry_after = _retry_after(resp)
+            if retry_after is not None:
+                guard.pause(retry_after)
+            error = f"HTTP {resp.status_code}: {resp.text[:200]}"
+        except (httpx.TimeoutException, httpx.NetworkError, httpx.RemoteProtocolError) as e:
+            error = repr(e)
+        except json.JSONDecodeError as e:
+            logging.error("JSON decode error for %s: %r (first 200 chars: %s)",
+                          response.request.url, e, response.text[:200])
+            guard.record_failure()
+            return None
+        except httpx.RequestError as e:
+            logging.error("RequestError for %s: %r", url, e)
+            guard.record_failure()
+            return None
+        except Exception as e:
+            logging.error("Unexpected error for %s: %r", url, e)
+            guard.record_failure()
+            return None
+
+        too_long = retry_after is not None and retry_after > RETRY_AFTER_MAX_S
+        if attempt == RETRIES or too_long or guard.state == "open":
+            logging.error("Giving up on %s after %d attempt(s): %s", url, attempt + 1, error)
+            guard.record_failure()
+            return None
+        delay = _backoff(attempt, retry_after)
+        guard.retries += 1
+        logging.warning("%s for %s, retry %d/%d in %.2fs", error, url, attempt + 1, RETRIES, delay)
+        await asyncio.sleep(delay)
+
+
+class StreamError(Exception):
+    '''
+    A streamed upstream response failed part way (already logged)
+    '''
+
+
+def can_stream() -> bool:
+    # incremental parsing needs the optional ijson package (pip install .[stream])
+    return ijson is not None
+
+
+async def _stream(url: str, params: Optional[dict[str, Any]], coro_factory) -> AsyncIterator[Any]:
+    '''
+    Feed the response body chunk by chunk into an ijson push parser and yield whatever
+    it produced after each chunk, so only one chunk plus the pending records are in memory
+    '''
+    # streams share the host's rate limit and breaker but are not retried, records may
+    # already have been handed to the caller when something breaks
+    guard = host_guard(url)
+    if not guard.allow():
+        logging.warning("Circuit for %s is open, not streaming %s", guard.host, url)
+        raise StreamError(f"circuit open for {guard.host}")
+    client = await get_client()
+    out = ijson.sendable_list()
+    parser = coro_factory(out)
+    try:
+        async with guard.slot(), client.stream("GET", url, params=params, timeout=_timeout_for(url)) as response:
+            if response.is_error:
+                await response.aread()
+                logging.error("HTTP %s for %s\nBody: %s", response.status_code, response.request.url, response.text[:500])
+                if response.status_code in RETRY_STATUSES:
+                    retry_after = _retry_after(response)
+                    if retry_after is not None:
+                        guard.pause(retry_after)
+                    guard.record_failure()
+                else:
+                    guard.record_success()
+                raise StreamError(f"HTTP {response.status_code} for {url}")
+            async for chunk in response.aiter_bytes():
+                parser.send(chunk)
+                for item in out:
+                    yield item
+                del out[:]
+        parser.close()
+        guard.record_success()
+        for item in out:
+            yield item
+    except ijson.JSONError as e:
+        logging.error("JSON decode error while streaming %s: %r", url, e)
+        guard.record_failure()
+        raise StreamError(str(e)) from e
+    except httpx.RequestError as e:
+        logging.error("RequestError while streaming %s: %r", url, e)
+        guard.record_failure()
+        raise StreamError(str(e)) from e
+    finally:
+        guard.release_probe()
+
+
+async def stream_items(url: str, prefix: str, params: Optional[dict[str, Any]] = None) -> AsyncIterator[Any]:
+    '''
+    Yield the JSON values found under `prefix` (ijson syntax, e.g. "events.item") one at
+    a time while the response downloads. Streaming bypasses the response cache and
+    single-flight: nothing is kept around to share.
+    '''
+    async for item in _stream(url, params, lambda out: ijson.items_coro(out, prefix, use_float=True)):
+        yield item
+
+
+async def stream_parse(url: str, params: Optional[dict[str, Any]] = None) -> AsyncIterator[tuple[str, str, Any]]:
+    '''
+    Yield raw ijson (prefix, event, value) triples, for documents keyed by record
+    (like POWER's {"parameter": {"NAME": {"YYYYMMDD": value}}}) rather than arrays
+    '''
+    async for item in _stream(url, params, lambda out: ijson.parse_coro(out, use_float=True)):
+        yield item